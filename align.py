@@ -4,25 +4,16 @@ sequences, aligns everything against the first sequence, and
 clips out insertions relative to this reference.  It generates
 a FASTA-formatted output file that will contain these aligned
 sequences.
+See pipeline.py for a version that takes file names as arguments.
 """
 
 # load modules
-import HyPhy
-import os
-import hyphyAlign
+import hphyAlign
 from seqUtils import convert_fasta
 
-# start an instance of HyPhy to communicate with
-hyphy = HyPhy._THyPhy (os.getcwd(), 1)
-
-
-# set HyPhy for nucleotide alignment
-hyphyAlign.change_settings(hyphy,
-                           alphabet=hyphyAlign.nucAlphabet,
-                           scoreMatrix=hyphyAlign.nucScoreMatrix,
-                           gapOpen=20, gapOpen2=20,
-                           gapExtend=10, gapExtend2=10,
-                           noTerminalPenalty=1)
+# HyPhy is started on the first alignment; the 'nucleotide' option set
+# has gap open 20, gap extend 10 and no terminal gap penalty
+aligner = hphyAlign.Aligner()
 
 # open the FASTA file and convert into a Python object
 # handle = open('test full1302.fasta', 'rU')
@@ -43,24 +34,13 @@ for header, sequence in fasta[1:]:
     new_seq = sequence.replace('-', '')
 
     # align this sequence against the reference
-    aquery, aref, ascore = hyphyAlign.pair_align(hyphy, refseq, new_seq)
+    aquery, aref, ascore = aligner.pair_align(refseq, new_seq)
 
     # see where in the reference the sequence aligned
-    left, right = hyphyAlign.get_boundaries(aref)
+    left, right = hphyAlign.get_boundaries(aref)
     
     # ignore insertions relative to reference
-    new_seq2 = ''  # initialize a new empty string
-    
-    # iterate over every base in the aligned sequence
-    for i, bp in enumerate(aquery):
-        
-        # examine the corresponding base in the aligned reference
-        if aref[i] == '-':
-            # if the reference contains a gap then this is an insertion
-            continue
-        
-        # otherwise concatenate this base to a new sequence
-        new_seq2 += aquery[i]
+    new_seq2 = hphyAlign.clip_insertions(aquery, aref)
 
     # write the result to our file
     # outfile.write('>%s\n%s\n' % (header, new_))
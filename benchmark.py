@@ -0,0 +1,263 @@
+"""
+Benchmark suite on synthetic data (see synthetic.py), to catch
+performance regressions.  Results are written as JSON so that runs
+can be compared:
+
+    python benchmark.py -o before.json
+    ... change something ...
+    python benchmark.py -o after.json --compare before.json
+
+Sequence benchmarks (FASTA parsing, alignment, consensus, entropy,
+bootstrap) are capped at --max-seqs sequences; tree benchmarks
+(GraphMaker.cluster, DOT export) run at every scale.  Module import
+times are measured first, each in a fresh interpreter (--imports-only
+to measure nothing else).
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import synthetic
+
+
+def timed (func, repeat):
+    """
+    Run [func] [repeat] times; returns the wall times and the last result.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+    return times, result
+
+
+# modules a short CLI run or worker process may start with
+IMPORT_MODULES = ['seqUtils', 'hphyAlign', 'qc', 'compacttree', 'treeindex', 'clustering',
+                  'clusterstats', 'graphmaker', 'njtree', 'sharedalign', 'export', 'metadata',
+                  'pipeline']
+
+_IMPORT_SCRIPT = 'import time; t = time.time(); import %s; print time.time() - t'
+
+def import_time (module):
+    """
+    Seconds taken to import [module] in a new interpreter, so that
+    nothing is already cached in sys.modules.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, '-c', _IMPORT_SCRIPT % module], cwd=here,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        lines = err.strip().splitlines()
+        raise ImportError(lines[-1] if lines else 'exit status %d' % proc.returncode)
+    return float(out)
+
+
+class Suite:
+    def __init__(self, scales, repeat=3, max_seqs=10000, max_align=200,
+                 length=synthetic.POL_LENGTH, cutoff=0.02, seed=1):
+        self.scales = scales
+        self.repeat = repeat
+        self.max_seqs = max_seqs
+        self.max_align = max_align
+        self.length = length
+        self.cutoff = cutoff
+        self.seed = seed
+        self.results = []
+        self.tmpdir = tempfile.mkdtemp(prefix='vancouver-bench-')
+
+    def close(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def record(self, name, n, func, items=None, repeat=None):
+        """
+        Time [func] and store the result; [items] is the number of
+        items processed per call, default [n].
+        """
+        times, result = timed(func, repeat or self.repeat)
+        best = min(times)
+        items = n if items is None else items
+        self.results.append({'benchmark': name, 'n': n, 'seconds': times, 'best': best,
+                             'items_per_s': items / best if best > 0 else None})
+        sys.stderr.write('%-20s n=%-8d %10.4fs\n' % (name, n, best))
+        return result
+
+    def skip(self, name, n, reason):
+        self.results.append({'benchmark': name, 'n': n, 'skipped': reason})
+        sys.stderr.write('%-20s n=%-8d skipped: %s\n' % (name, n, reason))
+
+    def imports(self, modules=IMPORT_MODULES):
+        for module in modules:
+            name = 'import_' + module
+            try:
+                times = [import_time(module) for i in range(self.repeat)]
+            except ImportError, e:
+                self.skip(name, 1, str(e))
+                continue
+            best = min(times)
+            self.results.append({'benchmark': name, 'n': 1, 'seconds': times, 'best': best,
+                                 'items_per_s': 1. / best if best > 0 else None})
+            sys.stderr.write('%-20s %-10s %10.4fs\n' % (name, '', best))
+
+    def run(self):
+        self.imports()
+        for n in self.scales:
+            if n > self.max_seqs:
+                for name in ('fasta_parse', 'align', 'consensus', 'entropy', 'bootstrap'):
+                    self.skip(name, n, 'more than --max-seqs sequences')
+            else:
+                self.sequences(n)
+            self.trees(n)
+
+    def sequences(self, n):
+        import seqUtils
+
+        fasta = synthetic.aligned_seqs(n, length=self.length, seed=self.seed)
+        path = os.path.join(self.tmpdir, 'aligned-%d.fa' % n)
+        handle = open(path, 'w')
+        seqUtils.write_fasta(fasta, handle)
+        handle.close()
+
+        def parse():
+            handle = open(path, 'rU')
+            try:
+                return seqUtils.convert_fasta(handle)
+            finally:
+                handle.close()
+        self.record('fasta_parse', n, parse)
+
+        self.align(min(n, self.max_align))
+
+        # column-wise routines on plain Python lists
+        self.record('consensus', n, lambda: seqUtils.consensus(fasta), items=n*self.length)
+        self.record('entropy', n, lambda: seqUtils.entropy_from_fasta(fasta), items=n*self.length)
+        random.seed(self.seed)
+        self.record('bootstrap', n, lambda: seqUtils.bootstrap(fasta), items=n*self.length)
+
+    def align(self, n):
+        try:
+            import HyPhy
+            import hphyAlign
+        except ImportError, e:
+            self.skip('align', n, 'HyPhy: %s' % e)
+            return
+
+        reference = synthetic.random_reference(self.length, seed=self.seed)
+        queries = synthetic.query_seqs(n, reference, seed=self.seed)
+        aligner = hphyAlign.Aligner()
+        aligner.preload()  # start HyPhy before timing
+
+        def run():
+            for h, s in queries:
+                aligner.pair_align(reference, s)
+        self.record('align', n, run, repeat=1)
+
+    def trees(self, n):
+        import export
+        from graphmaker import GraphMaker
+        from clustering import Clusters
+        from metadata import EpiTable
+
+        tree = self.record('tree_generate', n,
+                           lambda: synthetic.birth_death_tree(n, seed=self.seed), repeat=1)
+        gm = GraphMaker(tree)
+        pairs = self.record('cluster', n, lambda: gm.cluster(self.cutoff))
+        tip1, tip2, dists = gm.tip_edges(self.cutoff)
+        tipnames = gm.tree.names[gm.tree.tips]
+        clusters = Clusters(len(tipnames), tip1, tip2, dists)
+
+        csvfile = os.path.join(self.tmpdir, 'epi-%d.csv' % n)
+        handle = open(csvfile, 'w')
+        synthetic.write_epi_csv(handle, tipnames, seed=self.seed)
+        handle.close()
+        epidata = EpiTable.read(csvfile)
+        style = export.EpiNodeStyle(epidata)
+
+        dotfile = os.path.join(self.tmpdir, 'clusters-%d.dot' % n)
+        def write():
+            handle = open(dotfile, 'w')
+            try:
+                export.write_dot(handle, clusters, tipnames, min_size=2, style=style)
+            finally:
+                handle.close()
+        self.record('dot_export', n, write, items=len(pairs))
+
+    def report(self):
+        return {'python': platform.python_version(),
+                'platform': platform.platform(),
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'settings': {'scales': self.scales, 'repeat': self.repeat,
+                             'max_seqs': self.max_seqs, 'max_align': self.max_align,
+                             'length': self.length, 'cutoff': self.cutoff, 'seed': self.seed},
+                'results': self.results}
+
+
+def compare (old, new, handle=sys.stdout):
+    """
+    Print the ratio of best times, new over old, for benchmarks in both
+    reports.
+    """
+    before = dict(((r['benchmark'], r['n']), r['best']) for r in old['results'] if 'best' in r)
+    handle.write('%-20s %8s %10s %10s %7s\n' % ('benchmark', 'n', 'old', 'new', 'ratio'))
+    for r in new['results']:
+        key = (r['benchmark'], r['n'])
+        if 'best' not in r or key not in before:
+            continue
+        ratio = r['best'] / before[key] if before[key] > 0 else float('nan')
+        handle.write('%-20s %8d %10.4f %10.4f %7.2f\n' % (key[0], key[1], before[key],
+                                                           r['best'], ratio))
+
+
+def main ():
+    parser = argparse.ArgumentParser(description='Benchmarks on synthetic data.')
+    parser.add_argument('-o', '--output', help='JSON results file (default: stdout)')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-seqs', type=int, default=10000)
+    parser.add_argument('--max-align', type=int, default=200,
+                        help='number of queries to align at each scale')
+    parser.add_argument('--length', type=int, default=synthetic.POL_LENGTH)
+    parser.add_argument('--cutoff', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--compare', metavar='JSON', help='earlier results to compare against')
+    parser.add_argument('--imports-only', action='store_true',
+                        help='only time module imports')
+    args = parser.parse_args()
+
+    suite = Suite(args.scales, repeat=args.repeat, max_seqs=args.max_seqs,
+                  max_align=args.max_align, length=args.length, cutoff=args.cutoff,
+                  seed=args.seed)
+    try:
+        if args.imports_only:
+            suite.imports()
+        else:
+            suite.run()
+    finally:
+        suite.close()
+    report = suite.report()
+
+    if args.output:
+        handle = open(args.output, 'w')
+        json.dump(report, handle, indent=2, sort_keys=True)
+        handle.write('\n')
+        handle.close()
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if args.compare:
+        handle = open(args.compare)
+        old = json.load(handle)
+        handle.close()
+        compare(old, report, sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+"""
+Cluster extraction from lists of within-cutoff tip pairs using an
+array-based union-find, so that clusters can be followed across many
+distance cutoffs for the cost of one pass over the edges.
+"""
+from datetime import date
+import numpy as np
+
+
+class UnionFind:
+    """
+    Disjoint sets over elements 0..n-1 with union by size and path
+    compression.  Parent links and sizes are plain lists because they
+    are read and written one element at a time.
+    """
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.size = [1] * n
+        self.count = n  # number of disjoint sets
+    
+    
+    def __len__(self):
+        return len(self.parent)
+    
+    
+    def find (self, x):
+        """
+        Return the root of the set containing x.
+        """
+        parent = self.parent
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        # point every node on the path straight at the root
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+    
+    
+    def union (self, a, b):
+        """
+        Merge the sets containing a and b.  Returns the root of the
+        merged set, or -1 if they were already in the same set.
+        """
+        ra = self.find(a)
+        rb = self.find(b)
+        if ra == rb:
+            return -1
+        if self.size[ra] < self.size[rb]:
+            ra, rb = rb, ra
+        self.parent[rb] = ra
+        self.size[ra] += self.size[rb]
+        self.count -= 1
+        return ra
+    
+    
+    def extend (self, k):
+        """
+        Add k new singleton elements, numbered from the current size.
+        """
+        n = len(self.parent)
+        self.parent.extend(xrange(n, n+k))
+        self.size.extend([1] * k)
+        self.count += k
+    
+    
+    def labels (self):
+        """
+        Cluster label for every element, numbered 0..count-1 in order
+        of first appearance.
+        """
+        roots = np.array([self.find(x) for x in xrange(len(self.parent))], dtype=np.int64)
+        _, first, labels = np.unique(roots, return_index=True, return_inverse=True)
+        # renumber so that labels follow element order
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first, kind='mergesort')] = np.arange(len(first))
+        return rank[labels]
+
+
+def sweep (n, tip1, tip2, dists, cutoffs):
+    """
+    Cluster n elements at several distance cutoffs in one pass.
+    Edges (tip1[k], tip2[k]) are sorted by distance once and replayed
+    through a single union-find; clusters at each cutoff are read off
+    as the sweep passes it.  The edges only need to be computed at the
+    largest cutoff.
+    
+    Returns a list, in increasing order of cutoff, of dictionaries:
+        cutoff: the distance cutoff (edges strictly shorter are used)
+        labels: cluster label of every element
+        nclusters: number of clusters with two or more members
+        sizes: {cluster size: number of clusters} for those clusters
+    """
+    tip1 = np.asarray(tip1, dtype=np.int64)
+    tip2 = np.asarray(tip2, dtype=np.int64)
+    dists = np.asarray(dists, dtype=np.float64)
+    order = np.argsort(dists, kind='mergesort')
+    
+    uf = UnionFind(n)
+    res = []
+    k = 0
+    for cutoff in sorted(cutoffs):
+        stop = np.searchsorted(dists[order], cutoff, side='left')
+        for e in order[k:stop].tolist():
+            uf.union(tip1[e], tip2[e])
+        k = max(k, stop)
+        
+        labels = uf.labels()
+        counts = np.bincount(labels)
+        sizes, freqs = np.unique(counts[counts > 1], return_counts=True)
+        res.append({'cutoff': cutoff,
+                    'labels': labels,
+                    'nclusters': int(np.sum(counts > 1)),
+                    'sizes': dict(zip(sizes.tolist(), freqs.tolist()))})
+    return res
+
+
+def dendrogram (n, tip1, tip2, dists):
+    """
+    Full history of cluster merges as edges are added in order of
+    distance (single linkage).  Returns an array with one row per merge,
+    in the layout used by scipy.cluster.hierarchy:
+        [cluster a, cluster b, distance, size of merged cluster]
+    Elements are clusters 0..n-1 and the cluster formed by row i is n+i.
+    """
+    tip1 = np.asarray(tip1, dtype=np.int64)
+    tip2 = np.asarray(tip2, dtype=np.int64)
+    dists = np.asarray(dists, dtype=np.float64)
+    order = np.argsort(dists, kind='mergesort')
+    
+    uf = UnionFind(n)
+    cluster_id = list(range(n))  # union-find root -> dendrogram cluster id
+    merges = []
+    for e in order.tolist():
+        ra = uf.find(tip1[e])
+        rb = uf.find(tip2[e])
+        if ra == rb:
+            continue
+        root = uf.union(ra, rb)
+        merges.append((cluster_id[ra], cluster_id[rb], dists[e], uf.size[root]))
+        cluster_id[root] = n + len(merges) - 1
+    
+    return np.array(merges, dtype=np.float64).reshape(-1, 4)
+
+
+def quarters (start, end):
+    """
+    Date ordinals of the first day of every calendar quarter from the
+    quarter containing [start] to the first quarter after [end]
+    (datetime.date objects), for use as windows in temporal_sweep().
+    """
+    year, month = start.year, 3 * ((start.month-1) // 3) + 1
+    res = []
+    while True:
+        first = date(year, month, 1)
+        res.append(first.toordinal())
+        if first > end:
+            break
+        month += 3
+        if month > 12:
+            year, month = year+1, 1
+    return res
+
+
+def _carry_labels (roots, previous, next_label):
+    """
+    Labels for clusters given by their union-find [roots] (-1 for
+    elements not present), carried over from the [previous] window's
+    labels so that a label names the same cluster in every window.
+    Each cluster keeps the previous label it shares the most members
+    with (the smallest on ties); clusters with no earlier members get
+    new labels from [next_label] up, in order of first member.
+    Returns (labels, next_label).
+    """
+    labels = np.full(len(roots), -1, dtype=np.int64)
+    present = np.flatnonzero(roots >= 0)
+    if len(present) == 0:
+        return labels, next_label
+    cluster_roots, first, inverse = np.unique(roots[present], return_index=True,
+                                              return_inverse=True)
+    cluster_labels = np.full(len(cluster_roots), -1, dtype=np.int64)
+    
+    # overlap of every (cluster, previous label) pair; clusters only
+    # ever merge, so a previous label falls in exactly one cluster
+    old = previous[present] >= 0
+    if old.any():
+        keys, counts = np.unique(inverse[old] * next_label + previous[present][old],
+                                 return_counts=True)
+        cluster, label = np.divmod(keys, next_label)
+        best = np.lexsort((label, -counts, cluster))
+        keep = np.concatenate(([True], cluster[best[1:]] != cluster[best[:-1]]))
+        cluster_labels[cluster[best[keep]]] = label[best[keep]]
+    
+    fresh = np.flatnonzero(cluster_labels < 0)
+    fresh = fresh[np.argsort(first[fresh], kind='mergesort')]
+    cluster_labels[fresh] = np.arange(next_label, next_label+len(fresh))
+    labels[present] = cluster_labels[inverse]
+    return labels, next_label + len(fresh)
+
+
+def temporal_sweep (n, tip1, tip2, dists, dates, windows):
+    """
+    Cluster growth over time in a single pass.  An edge can only exist
+    once both of its sequences have been collected, so each edge is
+    dated by the later of its two tips; edges are sorted by that date
+    and replayed through one union-find, with a snapshot at the end of
+    every window.  The edges only need to be computed once, at the
+    cutoff of interest.
+    
+    n: number of elements (tips)
+    dates: collection date ordinal of every element; 0 (missing) is
+        treated as present from the start
+    windows: increasing date ordinals; window i runs from windows[i]
+        up to (not including) windows[i+1]
+    
+    Returns a list with one dictionary per window:
+        start, end: the window boundaries
+        labels: cluster label of every element, -1 if not collected yet;
+            a label refers to the same cluster in every window: when
+            clusters merge, the merged cluster keeps the label it shares
+            the most members with, and labels may therefore have gaps
+        nclusters: number of clusters with two or more members
+        new: number of elements collected in the window
+        growth: {cluster label: number of members collected in the
+            window} for clusters with two or more members that grew
+    """
+    tip1 = np.asarray(tip1, dtype=np.int64)
+    tip2 = np.asarray(tip2, dtype=np.int64)
+    dates = np.asarray(dates, dtype=np.int64)
+    edge_dates = np.maximum(dates[tip1], dates[tip2])
+    order = np.argsort(edge_dates, kind='mergesort')
+    sorted_dates = edge_dates[order]
+    
+    uf = UnionFind(n)
+    res = []
+    k = 0
+    labels = np.full(n, -1, dtype=np.int64)
+    next_label = 0
+    for start, end in zip(windows[:-1], windows[1:]):
+        stop = np.searchsorted(sorted_dates, end, side='left')
+        for e in order[k:stop].tolist():
+            uf.union(tip1[e], tip2[e])
+        k = stop
+        
+        present = dates < end
+        roots = np.array([uf.find(x) for x in xrange(n)], dtype=np.int64)
+        roots[~present] = -1
+        labels, next_label = _carry_labels(roots, labels, next_label)
+        counts = np.bincount(labels[present], minlength=next_label)
+        
+        arrived = present & (dates >= start)
+        grown = np.bincount(labels[arrived], minlength=len(counts))
+        growing = np.where((grown > 0) & (counts > 1))[0]
+        res.append({'start': start,
+                    'end': end,
+                    'labels': labels,
+                    'nclusters': int(np.sum(counts > 1)),
+                    'new': int(arrived.sum()),
+                    'growth': dict(zip(growing.tolist(), grown[growing].tolist()))})
+    return res
+
+
+class Clusters:
+    """
+    Connected components of a graph whose edges are streamed in,
+    without building a graph object.  Edges are kept in flat arrays
+    grouped by cluster, so the edges of cluster k are a contiguous
+    slice.
+    
+    Usage:
+    c = Clusters(ntips, tip1, tip2, dists)
+    for k in c.by_size(min_size=5):
+        members = c.members(k)
+        e1, e2, d = c.edges(k)
+    
+    labels: cluster label (0..nclusters-1) of every element
+    sizes: number of members in each cluster
+    """
+    def __init__(self, n, tip1=(), tip2=(), dists=()):
+        self.n = n
+        self.uf = UnionFind(n)
+        self._tip1 = []
+        self._tip2 = []
+        self._dists = []
+        self.add_edges(zip(tip1, tip2, dists))
+    
+    
+    @classmethod
+    def from_edges(cls, n, edges):
+        """
+        Build clusters from any iterable of (i, j, distance) tuples.
+        """
+        c = cls(n)
+        c.add_edges(edges)
+        return c
+    
+    
+    def add_edges (self, edges):
+        """
+        Stream (i, j, distance) tuples into the union-find.
+        """
+        union = self.uf.union
+        for i, j, d in edges:
+            union(i, j)
+            self._tip1.append(i)
+            self._tip2.append(j)
+            self._dists.append(d)
+        self._labels = None
+    
+    
+    def extend (self, k):
+        """
+        Add k new unlinked elements, numbered from n.
+        """
+        self.uf.extend(k)
+        self.n += k
+        self._labels = None
+    
+    
+    def _update (self):
+        # group members and edges by cluster label
+        self._labels = self.uf.labels()
+        self._sizes = np.bincount(self._labels, minlength=self.uf.count)
+        self._member_order = np.argsort(self._labels, kind='mergesort')
+        self._member_offsets = np.concatenate(([0], np.cumsum(self._sizes)))
+        
+        tip1 = np.array(self._tip1, dtype=np.int64)
+        edge_labels = self._labels[tip1] if len(tip1) else np.zeros(0, dtype=np.int64)
+        order = np.argsort(edge_labels, kind='mergesort')
+        self.tip1 = tip1[order]
+        self.tip2 = np.array(self._tip2, dtype=np.int64)[order]
+        self.dists = np.array(self._dists, dtype=np.float64)[order]
+        self._edge_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(edge_labels, minlength=len(self._sizes)))))
+    
+    
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._update()
+        return self._labels
+    
+    
+    @property
+    def sizes(self):
+        if self._labels is None:
+            self._update()
+        return self._sizes
+    
+    
+    def __len__(self):
+        return len(self.sizes)
+    
+    
+    def by_size (self, min_size=1):
+        """
+        Cluster labels with at least min_size members, largest first.
+        """
+        sizes = self.sizes
+        order = np.argsort(-sizes, kind='mergesort')
+        return order[sizes[order] >= min_size]
+    
+    
+    def members (self, k):
+        """
+        Element ids in cluster k.
+        """
+        if self._labels is None:
+            self._update()
+        return self._member_order[self._member_offsets[k]:self._member_offsets[k+1]]
+    
+    
+    def edges (self, k):
+        """
+        Edges in cluster k as slices (tip1, tip2, dists).
+        """
+        if self._labels is None:
+            self._update()
+        lo, hi = self._edge_offsets[k], self._edge_offsets[k+1]
+        return self.tip1[lo:hi], self.tip2[lo:hi], self.dists[lo:hi]
+    
+    
+    def to_networkx (self, names=None, min_size=1):
+        """
+        Export clusters with at least min_size members as a networkx.Graph
+        with a 'dist' attribute on every edge.  Only use this when
+        networkx is really needed; it is much heavier than these arrays.
+        """
+        import networkx as nx
+        g = nx.Graph()
+        for k in self.by_size(min_size):
+            for i, j, d in zip(*self.edges(k)):
+                if names is not None:
+                    i, j = names[i], names[j]
+                g.add_edge(i, j, dist=d)
+        return g
@@ -0,0 +1,276 @@
+"""
+Per-cluster summary statistics from cluster label arrays, computed for
+all clusters at once: size, patristic diameter, mean and median
+pairwise distance (via treeindex.LCAIndex), collection date span, and
+the fraction of members with flags such as resistance or late
+diagnosis.  Tables are dictionaries of NumPy columns and can be written
+as CSV or plain text.
+
+Diameter and mean distance come from the tree in O(n log n) for any
+cluster size; the median needs every pair of members, so it is only
+computed for clusters up to MEDIAN_MAX_SIZE members by default.
+"""
+from datetime import date
+import numpy as np
+
+
+# largest cluster whose member pairs are listed for the median distance
+MEDIAN_MAX_SIZE = 1000
+
+
+def group (labels):
+    """
+    Elements grouped by cluster label, skipping labels < 0 (e.g. not
+    yet collected in clustering.temporal_sweep).
+    Returns (order, offsets, sizes): element ids sorted by label, the
+    start of each cluster in [order], and cluster sizes.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    keep = np.flatnonzero(labels >= 0)
+    order = keep[np.argsort(labels[keep], kind='mergesort')]
+    sizes = np.bincount(labels[keep], minlength=labels.max()+1 if len(keep) else 0)
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    return order, offsets, sizes
+
+
+def member_pairs (labels, max_size=None):
+    """
+    Every pair of elements in the same cluster, without Python loops.
+    Clusters with more than [max_size] members are left out.
+    Returns arrays (a, b, label), grouped by label.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    order, offsets, sizes = group(labels)
+    if max_size is not None:
+        keep = np.flatnonzero((labels >= 0) & (sizes[np.maximum(labels, 0)] <= max_size))
+        masked = np.full(len(labels), -1, dtype=np.int64)
+        masked[keep] = labels[keep]
+        order, offsets, _ = group(masked)
+
+    # each element pairs with the members after it in its cluster
+    pos = np.arange(len(order))
+    ends = offsets[1:][labels[order]] if len(order) else pos
+    count = ends - pos - 1
+    first = np.repeat(pos, count)
+    starts = np.cumsum(count) - count
+    second = first + 1 + (np.arange(len(first)) - np.repeat(starts, count))
+    a = order[first]
+    b = order[second]
+    return a, b, labels[a]
+
+
+def pair_distances (labels, tips, index, max_size=None):
+    """
+    Patristic distances between all pairs of members of each cluster.
+    tips: node id of every element
+    index: treeindex.LCAIndex for the tree
+    Returns arrays (a, b, label, dist).
+    """
+    a, b, lab = member_pairs(labels, max_size)
+    tips = np.asarray(tips, dtype=np.int64)
+    dist = index.distances(np.column_stack((tips[a], tips[b])))
+    return a, b, lab, dist
+
+
+def tree_distances (labels, tips, index):
+    """
+    Diameter and mean pairwise patristic distance of every cluster,
+    without listing pairs of members.
+    tips: node id of every element
+    index: treeindex.LCAIndex for the tree (branch lengths >= 0)
+    Returns arrays (diameter, mean) indexed by label, NaN for clusters
+    with fewer than two members.
+
+    The diameter is found by a double sweep: the member farthest from
+    any member is an end of the longest path.  The sum of distances is
+    length * c * (k-c) summed over the branches spanned by the k
+    members, c of them below the branch.  Those branches form a tree
+    of the members and the LCAs of members adjacent in preorder, in
+    which a node's parent is its LCA with the node before it.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    order, offsets, sizes = group(labels)
+    nclusters = len(sizes)
+    diameter = np.full(nclusters, np.nan)
+    mean = np.full(nclusters, np.nan)
+    keep = order[sizes[labels[order]] > 1]
+    if len(keep) == 0:
+        return diameter, mean
+
+    # members by cluster, then in preorder
+    first = index.first
+    node = np.asarray(tips, dtype=np.int64)[keep]
+    lab = labels[keep]
+    o = np.lexsort((first[node], lab))
+    node = node[o]
+    lab = lab[o]
+    start = np.flatnonzero(np.concatenate(([True], lab[1:] != lab[:-1])))
+    stop = np.concatenate((start[1:], [len(lab)]))
+
+    def farthest (ends):
+        # member of each cluster farthest from ends[label], and distance
+        d = index.distances(np.column_stack((node, ends[lab])))
+        last = np.lexsort((d, lab))[stop-1]
+        return node[last], d[last]
+
+    ends = np.zeros(nclusters, dtype=np.int64)
+    ends[lab[start]] = node[start]
+    ends[lab[start]] = farthest(ends)[0]
+    diameter[lab[start]] = farthest(ends)[1]
+
+    # members plus LCAs of neighbours, by cluster and preorder
+    same = lab[1:] == lab[:-1]
+    m = len(index.tour)
+    vnode = np.concatenate((node, index.lca(node[:-1][same], node[1:][same])))
+    vlab = np.concatenate((lab, lab[1:][same]))
+    _, pos = np.unique(vlab * m + first[vnode], return_index=True)
+    vnode = vnode[pos]
+    vlab = vlab[pos]
+
+    # members below each node, from their sorted first positions
+    key = lab * m + first[node]
+    below = (np.searchsorted(key, vlab * m + index.last[vnode], side='right') -
+             np.searchsorted(key, vlab * m + first[vnode], side='left'))
+    child = np.flatnonzero(vlab[1:] == vlab[:-1]) + 1
+    up = index.lca(vnode[child-1], vnode[child])
+    length = index.depth[vnode[child]] - index.depth[up]
+    k = sizes[vlab[child]]
+    c = below[child]
+    total = np.bincount(vlab[child], weights=length * c * (k-c), minlength=nclusters)
+    big = sizes > 1
+    mean[big] = total[big] / (0.5 * sizes[big] * (sizes[big]-1))
+    return diameter, mean
+
+
+def summarize (labels, pairs=None, coldate=None, flags={}, min_size=2,
+               distances=None):
+    """
+    One row per cluster with at least [min_size] members, largest first.
+
+    labels: cluster label of every element (-1 to leave out)
+    pairs: (a, b, dist) for pairs of elements, e.g. from
+        pair_distances().  Pairs not within the same cluster under
+        [labels] are ignored, so the pairs for the largest cutoff of a
+        sweep can be reused at every smaller cutoff.
+    distances: (diameter, mean) arrays by label from tree_distances(),
+        used for those columns instead of [pairs]
+    coldate: collection date ordinal of every element, 0 if missing
+    flags: column name -> boolean array over elements (or float, NaN if
+        missing), reported as the fraction of members (with data) where
+        it holds, e.g. {'resistant': tiplabels.resistant}
+
+    Returns a dictionary of columns:
+        cluster, size: label and number of members
+        diameter, mean_dist, median_dist: over pairs of members (NaN
+            without pair distances, or for the median of clusters left
+            out of [pairs])
+        first_date, last_date, date_span: ordinals and days (0 if no
+            dates)
+        one column per flag
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    order, offsets, sizes = group(labels)
+    nclusters = len(sizes)
+    table = {}
+
+    clusters = np.argsort(-sizes, kind='mergesort')
+    clusters = clusters[sizes[clusters] >= min_size]
+    table['cluster'] = clusters
+    table['size'] = sizes[clusters]
+
+    # pairwise distances
+    diameter = np.full(nclusters, np.nan)
+    mean = np.full(nclusters, np.nan)
+    median = np.full(nclusters, np.nan)
+    if pairs is not None:
+        a, b, dist = [np.asarray(x) for x in pairs]
+        same = (labels[a] == labels[b]) & (labels[a] >= 0)
+        lab = labels[a][same]
+        dist = dist[same]
+        npairs = np.bincount(lab, minlength=nclusters)
+        has = npairs > 0
+        mean[has] = np.bincount(lab, weights=dist, minlength=nclusters)[has] / npairs[has]
+
+        # sort by cluster, then distance: slices give max and median
+        dist = dist[np.lexsort((dist, lab))]
+        start = np.concatenate(([0], np.cumsum(npairs)))[:-1]
+        diameter[has] = dist[start[has] + npairs[has] - 1]
+        lo = start[has] + (npairs[has]-1) // 2
+        hi = start[has] + npairs[has] // 2
+        median[has] = 0.5 * (dist[lo] + dist[hi])
+    if distances is not None:
+        diameter, mean = distances
+    table['diameter'] = diameter[clusters]
+    table['mean_dist'] = mean[clusters]
+    table['median_dist'] = median[clusters]
+
+    # collection dates, reduced over each cluster's slice of [order]
+    if coldate is not None:
+        dates = np.asarray(coldate, dtype=np.int64)[order]
+        nonempty = sizes > 0
+        starts = offsets[:-1][nonempty]
+        first = np.zeros(nclusters, dtype=np.int64)
+        last = np.zeros(nclusters, dtype=np.int64)
+        if len(dates):
+            missing = np.iinfo(np.int64).max
+            first[nonempty] = np.minimum.reduceat(np.where(dates > 0, dates, missing), starts)
+            last[nonempty] = np.maximum.reduceat(dates, starts)
+        first[last == 0] = 0
+        table['first_date'] = first[clusters]
+        table['last_date'] = last[clusters]
+        table['date_span'] = (last - first)[clusters]
+
+    # fractions of members with a flag
+    member_labels = labels[order]
+    for name, values in flags.iteritems():
+        values = np.asarray(values, dtype=np.float64)[order]
+        known = ~np.isnan(values)
+        hits = np.bincount(member_labels[known], weights=values[known], minlength=nclusters)
+        counts = np.bincount(member_labels[known], minlength=nclusters).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            table[name] = (hits / counts)[clusters]
+
+    return table
+
+
+COLUMNS = ['cluster', 'size', 'diameter', 'mean_dist', 'median_dist',
+           'first_date', 'last_date', 'date_span']
+
+def _columns (table, columns):
+    if columns is None:
+        columns = [c for c in COLUMNS if c in table]
+        columns += sorted(c for c in table if c not in COLUMNS)
+    return columns
+
+
+def _format (value, column):
+    if column in ('first_date', 'last_date'):
+        return date.fromordinal(value).isoformat() if value > 0 else ''
+    if isinstance(value, float):
+        return '' if value != value else '%.6g' % value
+    return str(value)
+
+
+def write_csv (handle, table, columns=None, sep=','):
+    """
+    Write a summary table with a header row; dates as YYYY-MM-DD and
+    missing values as empty fields.
+    """
+    columns = _columns(table, columns)
+    values = [table[c].tolist() for c in columns]
+    lines = [sep.join(columns)]
+    for row in zip(*values):
+        lines.append(sep.join(_format(v, c) for v, c in zip(row, columns)))
+    handle.write('\n'.join(lines) + '\n')
+
+
+def write_text (handle, table, columns=None):
+    """
+    Write a summary table as aligned plain text columns.
+    """
+    columns = _columns(table, columns)
+    cells = [[_format(v, c) for v in table[c].tolist()] for c in columns]
+    widths = [max([len(c)] + [len(s) for s in col]) for c, col in zip(columns, cells)]
+    handle.write('  '.join(c.rjust(w) for c, w in zip(columns, widths)) + '\n')
+    for row in zip(*cells):
+        handle.write('  '.join(s.rjust(w) for s, w in zip(row, widths)) + '\n')
@@ -0,0 +1,433 @@
+"""
+Immutable array-backed tree.  Nodes are integers numbered in depth-first
+preorder (root is 0, and every subtree is a contiguous range of ids
+starting at its root), with the topology held in NumPy arrays instead
+of Bio.Phylo Clade objects.
+"""
+import os
+import re
+import hashlib
+import tempfile
+import numpy as np
+
+
+class CompactTree:
+    """
+    Usage:
+    from Bio import Phylo
+    from compacttree import CompactTree
+    ct = CompactTree.from_phylo(Phylo.read('foo.tree', 'newick'))
+    for child in ct.children(0):
+        print ct.branch_length[child]
+    t = ct.to_phylo()
+
+    parent: parent node id, -1 for the root
+    first_child, next_sibling: child lists, -1 where there is none
+    branch_length: length of the branch above each node
+    names: tip labels (None for internal nodes and unlabelled tips)
+    tips: node ids of the tips, in preorder
+    subtree_end: one past the last node id in each node's subtree
+    """
+    def __init__(self, parent, branch_length, names):
+        n = len(parent)
+        self.parent = np.asarray(parent, dtype=np.int32)
+        self.branch_length = np.asarray(branch_length, dtype=np.float64)
+        self.names = np.empty(n, dtype=object)
+        self.names[:] = names
+        
+        if n > 1 and (self.parent[0] != -1 or np.any(self.parent[1:] >= np.arange(1, n))):
+            raise ValueError('CompactTree nodes must be numbered in preorder')
+        
+        # siblings are consecutive in a stable sort on parent id
+        order = np.argsort(self.parent[1:], kind='mergesort') + 1
+        sorted_parent = self.parent[order]
+        self.first_child = np.full(n, -1, dtype=np.int32)
+        self.next_sibling = np.full(n, -1, dtype=np.int32)
+        same = sorted_parent[1:] == sorted_parent[:-1]
+        self.next_sibling[order[:-1][same]] = order[1:][same]
+        starts = np.ones(len(order), dtype=bool)
+        starts[1:] = ~same
+        self.first_child[sorted_parent[starts]] = order[starts]
+        
+        self.is_tip = self.first_child < 0
+        self.tips = np.where(self.is_tip)[0].astype(np.int32)
+        
+        # subtree of node i is ids i..subtree_end[i]-1; this also rejects
+        # numberings that are not depth-first, e.g. breadth-first
+        self.subtree_end = _subtree_ends(self.parent, self.next_sibling)
+        if not _is_depth_first(self.parent, self.subtree_end):
+            raise ValueError('CompactTree nodes must be numbered in depth-first preorder')
+        
+        for arr in (self.parent, self.branch_length, self.names, self.first_child,
+                    self.next_sibling, self.is_tip, self.tips, self.subtree_end):
+            arr.setflags(write=False)
+    
+    
+    def __len__(self):
+        return len(self.parent)
+    
+    
+    @property
+    def ntips(self):
+        return len(self.tips)
+    
+    
+    def children(self, node):
+        """
+        Iterate over the child node ids of [node].
+        """
+        child = self.first_child[node]
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+    
+    
+    def depths(self):
+        """
+        Root-to-node path lengths.  Parents precede children, so one
+        pass in id order is enough.
+        """
+        depth = self.branch_length.copy()
+        depth[0] = 0.
+        parent = self.parent
+        for i in xrange(1, len(depth)):
+            depth[i] += depth[parent[i]]
+        return depth
+    
+    
+    def subtree_sizes(self):
+        """
+        Number of nodes and number of tips in the subtree below each node.
+        In preorder the subtree of node i is ids i..i+size[i]-1.
+        """
+        ids = np.arange(len(self))
+        size = self.subtree_end - ids
+        tip_count = np.concatenate(([0], np.cumsum(self.is_tip, dtype=np.int64)))
+        return size, tip_count[self.subtree_end] - tip_count[ids]
+    
+    
+    @classmethod
+    def from_phylo(cls, tree):
+        """
+        Convert a Bio.Phylo tree, numbering clades in preorder.
+        """
+        parent = []
+        branch_length = []
+        names = []
+        stack = [(tree.root, -1)]
+        while stack:
+            clade, p = stack.pop()
+            i = len(parent)
+            parent.append(p)
+            branch_length.append(clade.branch_length or 0.)
+            names.append(clade.name if clade.is_terminal() else None)
+            for child in reversed(clade.clades):
+                stack.append((child, i))
+        return cls(parent, branch_length, names)
+    
+    
+    @classmethod
+    def from_newick(cls, path):
+        """
+        Read a Newick tree file.  See load_tree() for a cached version.
+        """
+        handle = open(path, 'rU')
+        try:
+            return parse_newick(handle.read())
+        finally:
+            handle.close()
+    
+    
+    def insert_tips(self, placements):
+        """
+        Return a new tree with tips attached to existing branches.
+        The tree itself is immutable, so the arrays are rebuilt (in
+        preorder again); old node ids map to new ones through the
+        returned array.
+        
+        placements: list of (name, node, position, pendant) where the
+            new tip is attached to the branch above [node] at distance
+            [position] from the parent end, on a branch of length [pendant]
+        
+        Returns (tree, new_ids) with new_ids[old node id] = new node id
+        """
+        n = len(self)
+        children = [list(self.children(i)) for i in xrange(n)]
+        parent = self.parent.tolist()
+        branch_length = self.branch_length.tolist()
+        names = list(self.names)
+        
+        by_edge = {}
+        for name, node, position, pendant in placements:
+            if parent[node] < 0:
+                raise ValueError('Cannot attach a tip above the root')
+            if not 0. <= position <= branch_length[node]:
+                raise ValueError('Position %f is outside branch of length %f above node %d' % (
+                    position, branch_length[node], node))
+            by_edge.setdefault(node, []).append((position, name, pendant))
+        
+        # split each branch into a chain of new internal nodes, one per tip
+        for node, tips in by_edge.iteritems():
+            tips.sort()
+            p = parent[node]
+            slot = children[p].index(node)
+            last = 0.
+            for position, name, pendant in tips:
+                x = len(parent)
+                parent.append(p)
+                branch_length.append(position - last)
+                names.append(None)
+                children.append([])
+                children[p][slot] = x
+                
+                tip = len(parent)
+                parent.append(x)
+                branch_length.append(pendant)
+                names.append(name)
+                children.append([])
+                
+                children[x] = [node, tip]
+                p, slot, last = x, 0, position
+            parent[node] = p
+            branch_length[node] -= last
+        
+        # renumber in preorder
+        order = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(reversed(children[node]))
+        new_ids = np.empty(len(order), dtype=np.int32)
+        new_ids[order] = np.arange(len(order))
+        
+        new_parent = [new_ids[parent[i]] if parent[i] >= 0 else -1 for i in order]
+        tree = CompactTree(new_parent, [branch_length[i] for i in order], [names[i] for i in order])
+        return tree, new_ids[:n]
+    
+    
+    def to_newick(self):
+        """
+        Newick string for the tree, written without recursion.  Labels
+        with Newick punctuation or whitespace are quoted.
+        """
+        names = self.names
+        branch_length = self.branch_length.tolist()
+        out = []
+        # (node, True) opens a node, (node, False) closes it
+        stack = [(0, True)]
+        while stack:
+            node, opening = stack.pop()
+            if opening:
+                children = list(self.children(node))
+                if children:
+                    out.append('(')
+                    stack.append((node, False))
+                    for k, c in enumerate(reversed(children)):
+                        stack.append((c, True))
+                        if k < len(children)-1:
+                            stack.append((None, None))  # comma
+                    continue
+                out.append(newick_label(names[node]))
+            elif node is None:
+                out.append(',')
+                continue
+            else:
+                out.append(')')
+            if node > 0:
+                out.append(':%r' % branch_length[node])
+        out.append(';\n')
+        return ''.join(out)
+    
+    
+    def write_newick(self, path):
+        handle = open(path, 'w')
+        try:
+            handle.write(self.to_newick())
+        finally:
+            handle.close()
+    
+    
+    def to_phylo(self):
+        """
+        Build a Bio.Phylo tree with the same topology, branch lengths
+        and tip labels.
+        """
+        from Bio.Phylo.BaseTree import Tree, Clade
+        clades = [Clade(branch_length=float(self.branch_length[i]), name=self.names[i])
+                  for i in xrange(len(self))]
+        for i in xrange(1, len(self)):
+            clades[self.parent[i]].clades.append(clades[i])
+        return Tree(root=clades[0], rooted=True)
+
+
+def _subtree_ends (parent, next_sibling):
+    # one past the last id below each node, if numbered depth-first: the
+    # next sibling of the nearest ancestor (or the node itself) that has
+    # one, found by pointer jumping
+    n = len(parent)
+    ids = np.arange(n, dtype=np.int64)
+    stop = next_sibling >= 0
+    if n:
+        stop[0] = True
+    up = np.where(stop, ids, parent)
+    while True:
+        jumped = up[up]
+        if np.array_equal(jumped, up):
+            break
+        up = jumped
+    return np.where(next_sibling[up] >= 0, next_sibling[up], n).astype(np.int64)
+
+
+def _is_depth_first (parent, end):
+    # every child's range lies inside its parent's and every range holds
+    # exactly its node and its children's ranges, so ranges are subtrees
+    n = len(parent)
+    size = end - np.arange(n)
+    if np.any(size < 1):
+        return False
+    if n < 2:
+        return True
+    if np.any(end[1:] > end[parent[1:]]):
+        return False
+    below = np.bincount(parent[1:], weights=size[1:], minlength=n)
+    return np.array_equal(below.astype(np.int64) + 1, size)
+
+
+# quoted labels, comments, punctuation, and runs of anything else
+newick_token = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),:;]|[^(),:;\s\[']+")
+
+newick_special = re.compile(r"[(),:;\[\]'\s]")
+
+def newick_label (name):
+    if not name:
+        return ''
+    if newick_special.search(name):
+        return "'%s'" % name.replace("'", "''")
+    return name
+
+
+def parse_newick (text):
+    """
+    Parse a Newick string into a CompactTree without recursion, so
+    ladder-like trees of any depth can be read.  Tokens are scanned
+    with one regular expression over the whole buffer.  Nodes are
+    numbered in the order their '(' or tip label appears, which is
+    preorder.  Internal node labels (e.g. bootstrap support) and
+    comments are skipped.
+    """
+    parent = []
+    branch_length = []
+    names = []
+    
+    stack = []  # open internal nodes
+    current = -1  # node that a following label or length belongs to
+    expect_child = True  # just saw '(' or ','
+    after_colon = False
+    
+    for m in newick_token.finditer(text):
+        token = m.group()
+        c = token[0]
+        
+        if c == '[':
+            continue
+        
+        if after_colon:
+            branch_length[current] = float(token)
+            after_colon = False
+            continue
+        
+        if c == '(':
+            current = len(parent)
+            parent.append(stack[-1] if stack else -1)
+            branch_length.append(0.)
+            names.append(None)
+            stack.append(current)
+            expect_child = True
+        elif c == ',' or c == ')':
+            if expect_child:
+                # unlabelled tip, e.g. "(,)"
+                parent.append(stack[-1])
+                branch_length.append(0.)
+                names.append(None)
+            if c == ')':
+                current = stack.pop()
+                expect_child = False
+            else:
+                expect_child = True
+        elif c == ':':
+            if expect_child:
+                # unlabelled tip with a branch length, e.g. "(:0.1,B:0.2)"
+                current = len(parent)
+                parent.append(stack[-1] if stack else -1)
+                branch_length.append(0.)
+                names.append(None)
+                expect_child = False
+            after_colon = True
+        elif c == ';':
+            break
+        elif expect_child:
+            # tip label
+            if c == "'":
+                token = token[1:-1].replace("''", "'")
+            current = len(parent)
+            parent.append(stack[-1] if stack else -1)
+            branch_length.append(0.)
+            names.append(token)
+            expect_child = False
+        # else: label of an internal node, ignored
+    
+    if stack:
+        raise ValueError('Unbalanced parentheses in Newick string')
+    return CompactTree(parent, branch_length, names)
+
+
+def file_hash (path, blocksize=1 << 20):
+    """
+    SHA-1 of a file's contents, read in blocks.
+    """
+    h = hashlib.sha1()
+    handle = open(path, 'rb')
+    try:
+        block = handle.read(blocksize)
+        while block:
+            h.update(block)
+            block = handle.read(blocksize)
+    finally:
+        handle.close()
+    return h.hexdigest()
+
+
+def load_tree (path, cache_dir=None):
+    """
+    Read a Newick tree file into a CompactTree.  If [cache_dir] is
+    given, the parsed arrays are saved there as a binary .npz file
+    keyed by the hash of the tree file, and reused on the next load.
+    """
+    if cache_dir is None:
+        return CompactTree.from_newick(path)
+    
+    cache_path = os.path.join(cache_dir, 'tree-%s.npz' % file_hash(path))
+    if os.path.exists(cache_path):
+        data = np.load(cache_path)
+        try:
+            # unlabelled tips and internal nodes are saved as ''
+            names = [str(s) or None for s in data['names']]
+            return CompactTree(data['parent'], data['branch_length'], names)
+        finally:
+            data.close()
+    
+    tree = CompactTree.from_newick(path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    
+    # write to a temporary file first so readers never see half a cache
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.npz')
+    handle = os.fdopen(fd, 'wb')
+    try:
+        np.savez(handle, parent=tree.parent, branch_length=tree.branch_length,
+                 names=np.array([s or '' for s in tree.names], dtype=str))
+    finally:
+        handle.close()
+    os.rename(tmp, cache_path)
+    return tree
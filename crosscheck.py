@@ -0,0 +1,144 @@
+"""
+Cross-checks of the fast code paths against plain reference versions
+on synthetic data (see synthetic.py), to run after changing either:
+
+    python crosscheck.py
+    python crosscheck.py tip_pairs_parallel nj_tree
+
+Every check prints 'ok' or what differed; the exit status is the
+number of failed checks.
+"""
+import sys
+import argparse
+import numpy as np
+import synthetic
+
+
+def _pair_set (res1, res2, dists):
+    # {(tip, tip): distance} regardless of the order pairs were found in
+    return dict(((min(a, b), max(a, b)), d) for a, b, d in zip(res1, res2, dists))
+
+
+def _same_pairs (expected, found, tol=1e-9):
+    if sorted(expected) != sorted(found):
+        missing = len(set(expected) - set(found))
+        extra = len(set(found) - set(expected))
+        return '%d pairs missing, %d extra' % (missing, extra)
+    worst = max([abs(expected[k] - found[k]) for k in expected] or [0.])
+    if worst > tol:
+        return 'distances differ by up to %g' % worst
+    return None
+
+
+def check_tip_pairs_parallel (ntips=3000, cutoff=0.02, processes=2, seed=1):
+    """
+    GraphMaker.tip_pairs() split over worker processes gives the same
+    pairs and distances as the serial pass, in the same order.
+    """
+    from graphmaker import GraphMaker
+    gm = GraphMaker(synthetic.birth_death_tree(ntips, seed=seed), tip_labels=[])
+    serial = zip(*gm.tip_pairs(cutoff))
+    parallel = zip(*gm.tip_pairs(cutoff, processes=processes))
+    if not serial:
+        return 'no pairs within cutoff %g' % cutoff
+    if serial != parallel:
+        problem = _same_pairs(_pair_set(*zip(*serial)), _pair_set(*zip(*parallel)))
+        if problem:
+            return problem
+        first = min(i for i, (a, b) in enumerate(zip(serial, parallel)) if a != b)
+        return 'same pairs in a different order from pair %d' % first
+    return None
+
+
+def _naive_nj (dist):
+    # textbook O(n^3) neighbour joining, with the same branch length
+    # clamping as njtree.nj_tree(); returns the patristic distances
+    # between tips of the tree it builds
+    d = np.array(dist, dtype=np.float64)
+    n = len(d)
+    patristic = np.zeros((n, n))
+    clusters = [[(i, 0.)] for i in xrange(n)]  # (tip, distance to cluster root)
+    active = range(n)
+    while len(active) > 2:
+        m = len(active)
+        sub = d[np.ix_(active, active)]
+        r = sub.sum(axis=1)
+        q = sub - r[:, None] / (m-2) - r[None, :] / (m-2)
+        q[np.tril_indices(m)] = np.inf
+        i, j = divmod(q.argmin(), m)
+        a, b = active[i], active[j]
+        li = 0.5*d[a, b] + (r[i]-r[j]) / (2.*(m-2))
+        li = min(max(li, 0.), d[a, b])
+        lj = d[a, b] - li
+        for x, dx in clusters[a]:
+            for y, dy in clusters[b]:
+                patristic[x, y] = patristic[y, x] = dx + li + dy + lj
+        others = [k for k in active if k != a and k != b]
+        d[a, others] = d[others, a] = 0.5 * (d[a, others] + d[b, others] - d[a, b])
+        clusters[a] = [(x, dx+li) for x, dx in clusters[a]] + [(y, dy+lj) for y, dy in clusters[b]]
+        active.remove(b)
+    a, b = active
+    for x, dx in clusters[a]:
+        for y, dy in clusters[b]:
+            patristic[x, y] = patristic[y, x] = dx + dy + d[a, b]
+    return patristic
+
+
+def _tree_patristic (tree, names):
+    # patristic distances between tips, in the order of [names]
+    from treeindex import LCAIndex
+    index = LCAIndex(tree.parent, tree.branch_length)
+    node = dict((tree.names[i], i) for i in tree.tips.tolist())
+    tips = np.array([node[name] for name in names], dtype=np.int64)
+    a, b = np.meshgrid(tips, tips, indexing='ij')
+    return index.distances(np.column_stack((a.ravel(), b.ravel()))).reshape(len(tips), len(tips))
+
+
+def check_nj_tree (ntaxa=150, seed=1, tol=1e-9):
+    """
+    njtree.nj_tree() builds the same tree as textbook neighbour joining,
+    compared as patristic distances between tips, on a random distance
+    matrix and on distances from a synthetic alignment.
+    """
+    import njtree
+    rs = np.random.RandomState(seed)
+    random = rs.random_sample((ntaxa, ntaxa))
+    random = random + random.T
+    np.fill_diagonal(random, 0.)
+    fasta = synthetic.aligned_seqs(ntaxa, length=600, seed=seed)
+    aligned = njtree.distance_matrix(njtree.encode([s for h, s in fasta]))
+
+    for label, dist in (('random matrix', random), ('alignment', aligned)):
+        names = ['t%d' % i for i in xrange(ntaxa)]
+        found = _tree_patristic(njtree.nj_tree(dist, names, chunk=4, block=32), names)
+        worst = np.abs(found - _naive_nj(dist)).max()
+        if worst > tol:
+            return '%s: patristic distances differ by up to %g' % (label, worst)
+    return None
+
+
+CHECKS = [('tip_pairs_parallel', check_tip_pairs_parallel),
+          ('nj_tree', check_nj_tree)]
+
+
+def main ():
+    parser = argparse.ArgumentParser(description='Cross-check fast code paths.')
+    parser.add_argument('checks', nargs='*', help='checks to run (default: all): %s' %
+                        ', '.join(name for name, func in CHECKS))
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(name for name, func in CHECKS)
+    if unknown:
+        parser.error('unknown checks: %s' % ', '.join(sorted(unknown)))
+
+    failed = 0
+    for name, func in CHECKS:
+        if args.checks and name not in args.checks:
+            continue
+        problem = func()
+        sys.stdout.write('%-24s %s\n' % (name, problem or 'ok'))
+        failed += problem is not None
+    sys.exit(failed)
+
+
+if __name__ == "__main__":
+    main()
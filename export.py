@@ -0,0 +1,293 @@
+"""
+Streaming export of clusters (see clustering.Clusters) to GraphViz DOT,
+GraphML, CSV or binary edge lists, and JSON for web viewers.  Nodes are
+styled by a pluggable callable that maps a node name to a dictionary of
+attributes, so the same styling rules work for every format.
+"""
+import json
+import numpy as np
+from xml.sax.saxutils import escape, quoteattr
+
+
+class BufferedWriter:
+    """
+    Collect small strings and write them to [handle] in large chunks.
+    """
+    def __init__(self, handle, bufsize=1 << 16):
+        self.handle = handle
+        self.bufsize = bufsize
+        self.chunks = []
+        self.size = 0
+
+    def write(self, s):
+        self.chunks.append(s)
+        self.size += len(s)
+        if self.size >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        self.handle.write(''.join(self.chunks))
+        self.chunks = []
+        self.size = 0
+
+
+def clean_name (name):
+    # tildes in StudyIDs are not wanted in the output
+    return name.replace('~', '')
+
+
+class EpiNodeStyle:
+    """
+    Node styling from epidemiological metadata, as used for the Vancouver
+    cluster figures:
+        label: exposure (risk factor) code
+        xlabel: StudyID without the 6-character collection date suffix
+        fillcolor: gender (blue male, red female, white missing)
+        shape: hexagon if AIDS at diagnosis, else circle
+        width: scaled to year of onset
+
+    table: metadata.EpiTable
+    columns: names of the gender, exposure, onset year and AIDS at
+        diagnosis columns in [table]
+    The rules are evaluated once per distinct value of each column, not
+    per node.  Returns None for nodes without metadata.
+    """
+    # node labels for risk factors
+    exposures = {
+        'OriginHP': 'O',
+        'HeteroWithOriginHP': 'HO',
+        'Unk/Miss': '',
+        'MSM': 'M',
+        'Bi': 'B',
+        'Hetero': 'H',
+        'Hetero+IDU': 'HI',
+        'MotherRisk': 'W',
+        'IDU': 'I',
+        'MSM+IDU': 'IM',
+        'Bi+IDU': 'BI',
+        'Other': '',
+        'HeteroWithBi': 'BH',
+        'Hetro': 'H',
+        'HetroWithBi': 'HB',
+        '': ''
+    }
+
+    # RGBA hex codes; the last two digits are transparency
+    gender = {'MALE': '#0000FF30', 'FEMALE': '#FF000030'}
+
+    def __init__(self, table, missing_onset=2009, first_year=1977, last_year=2013,
+                 columns={'Sex': 'Gender', 'Expose': 'Expose',
+                          'YROnset': 'YROnset', 'AIDSatDiag': 'LATE?'}):
+        self.table = table
+
+        def onset(value):
+            # 'Y', blank and implausible years are missing
+            try:
+                year = int(value)
+            except ValueError:
+                return missing_onset  # about the median
+            return missing_onset if year < 1970 else year
+
+        def width(value):
+            return max(0., 0.5 * float(onset(value)-first_year) / (last_year-first_year))
+
+        self.label = table.map(columns['Expose'], lambda e: self.exposures.get(e, ''))
+        self.fillcolor = table.map(columns['Sex'], lambda s: self.gender.get(s, '#FFFFFF30'))
+        self.shape = table.map(columns['AIDSatDiag'], lambda a: 'hexagon' if a == 'Y' else 'circle')
+        self.width = table.map(columns['YROnset'], width)
+
+    def __call__(self, name):
+        row = self.table.row(name)
+        if row < 0:
+            return None
+        return {'label': self.label[row],
+                'xlabel': clean_name(name)[:-6],
+                'fillcolor': self.fillcolor[row],
+                'shape': self.shape[row],
+                'width': self.width[row]}
+
+
+def _cluster_edges (clusters, min_size):
+    # (label, tip1, tip2, dists) for each cluster, largest first
+    for k in clusters.by_size(min_size):
+        tip1, tip2, dists = clusters.edges(k)
+        yield k, tip1, tip2, dists
+
+
+def _cluster_nodes (clusters, min_size):
+    # element ids of nodes in the exported clusters
+    keep = clusters.sizes[clusters.labels] >= min_size
+    return np.where(keep)[0]
+
+
+# =====================================
+# GraphViz DOT
+
+DOT_PREAMBLE = [
+    'outputorder=edgesfirst;',
+    '\tnode [width=0.25,height=0.25,style="filled",fontname="Helvetica",fontsize="9pt"];',
+    '\tedge [color="#77777730"];'
+]
+
+def dot_attrs (attrs):
+    """
+    Format a dictionary as a DOT attribute list.
+    """
+    items = []
+    for key in sorted(attrs):
+        value = attrs[key]
+        if isinstance(value, float):
+            items.append('%s=%f' % (key, value))
+        elif isinstance(value, (int, long)):
+            items.append('%s=%d' % (key, value))
+        else:
+            items.append('%s="%s"' % (key, value))
+    return ','.join(items)
+
+
+def dot_edge (name1, name2, attrs):
+    return '\t"%s"--"%s" [%s];\n' % (name1, name2, dot_attrs(attrs))
+
+
+def dot_node (name, attrs):
+    return '\t"%s" [%s];\n' % (name, dot_attrs(attrs))
+
+
+def write_dot (handle, clusters, names, min_size=1, style=None,
+               edge_attrs=None, graph_name='clusters', preamble=DOT_PREAMBLE):
+    """
+    Write clusters with at least [min_size] members as an undirected
+    GraphViz graph: global options, then all edges, then styled nodes.
+
+    names: node names, indexed like the clusters' elements
+    style: callable from node name to a dictionary of node attributes
+        (or None to leave the node out), e.g. EpiNodeStyle
+    edge_attrs: callable from distance to a dictionary of edge attributes;
+        default is {'len': dist}
+    """
+    out = BufferedWriter(handle)
+    out.write('graph %s\n{\n' % graph_name)
+    for line in preamble:
+        out.write(line + '\n')
+
+    for k, tip1, tip2, dists in _cluster_edges(clusters, min_size):
+        for i, j, dist in zip(tip1.tolist(), tip2.tolist(), dists.tolist()):
+            attrs = edge_attrs(dist) if edge_attrs else {'len': dist}
+            out.write(dot_edge(clean_name(names[i]), clean_name(names[j]), attrs))
+
+    if style is not None:
+        for i in _cluster_nodes(clusters, min_size).tolist():
+            attrs = style(names[i])
+            if attrs is not None:
+                out.write(dot_node(clean_name(names[i]), attrs))
+
+    out.write('}\n')
+    out.flush()
+
+
+# =====================================
+# GraphML
+
+def write_graphml (handle, clusters, names, min_size=1, style=None, keys=()):
+    """
+    Write clusters as GraphML, with the cluster label and any node
+    attributes from [style] listed in [keys] as node data, and the
+    distance as edge data.
+    """
+    out = BufferedWriter(handle)
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+    out.write('  <key id="cluster" for="node" attr.name="cluster" attr.type="int"/>\n')
+    for key in keys:
+        out.write('  <key id=%s for="node" attr.name=%s attr.type="string"/>\n' % (
+            quoteattr(key), quoteattr(key)))
+    out.write('  <key id="dist" for="edge" attr.name="dist" attr.type="double"/>\n')
+    out.write('  <graph id="clusters" edgedefault="undirected">\n')
+
+    labels = clusters.labels
+    for i in _cluster_nodes(clusters, min_size).tolist():
+        name = clean_name(names[i])
+        out.write('    <node id=%s><data key="cluster">%d</data>' % (quoteattr(name), labels[i]))
+        attrs = style(names[i]) if style is not None else None
+        if attrs:
+            for key in keys:
+                if key in attrs:
+                    out.write('<data key=%s>%s</data>' % (quoteattr(key), escape(str(attrs[key]))))
+        out.write('</node>\n')
+
+    for k, tip1, tip2, dists in _cluster_edges(clusters, min_size):
+        for i, j, dist in zip(tip1.tolist(), tip2.tolist(), dists.tolist()):
+            out.write('    <edge source=%s target=%s><data key="dist">%r</data></edge>\n' % (
+                quoteattr(clean_name(names[i])), quoteattr(clean_name(names[j])), dist))
+
+    out.write('  </graph>\n</graphml>\n')
+    out.flush()
+
+
+# =====================================
+# edge lists
+
+edge_dtype = np.dtype([('tip1', '<i4'), ('tip2', '<i4'), ('dist', '<f8'), ('cluster', '<i4')])
+
+def write_edgelist (handle, clusters, names=None, min_size=1, binary=False):
+    """
+    Write one row per edge: tip1, tip2, distance, cluster label.
+    CSV output uses node names, or element ids if [names] is None.
+    Binary output is a packed array of
+    edge_dtype records with element ids (read back with
+    numpy.fromfile(path, dtype=export.edge_dtype)); write the names
+    separately.
+    """
+    if binary:
+        for k, tip1, tip2, dists in _cluster_edges(clusters, min_size):
+            rec = np.empty(len(tip1), dtype=edge_dtype)
+            rec['tip1'] = tip1
+            rec['tip2'] = tip2
+            rec['dist'] = dists
+            rec['cluster'] = k
+            handle.write(rec.tobytes())
+        return
+
+    out = BufferedWriter(handle)
+    out.write('tip1,tip2,dist,cluster\n')
+    label = str if names is None else lambda i: clean_name(names[i])
+    for k, tip1, tip2, dists in _cluster_edges(clusters, min_size):
+        for i, j, dist in zip(tip1.tolist(), tip2.tolist(), dists.tolist()):
+            out.write('%s,%s,%r,%d\n' % (label(i), label(j), dist, k))
+    out.flush()
+
+
+# =====================================
+# JSON
+
+def write_json (handle, clusters, names, min_size=1, style=None):
+    """
+    Write clusters as a node-link JSON document for web viewers such
+    as d3.js:
+        {"nodes": [{"id": ..., "cluster": ..., <style attributes>}, ...],
+         "links": [{"source": ..., "target": ..., "dist": ...}, ...]}
+    Nodes and links are serialised one at a time.
+    """
+    out = BufferedWriter(handle)
+    labels = clusters.labels
+
+    out.write('{"nodes": [')
+    sep = '\n'
+    for i in _cluster_nodes(clusters, min_size).tolist():
+        node = {'id': clean_name(names[i]), 'cluster': int(labels[i])}
+        attrs = style(names[i]) if style is not None else None
+        if attrs:
+            node.update(attrs)
+        out.write(sep + json.dumps(node, sort_keys=True))
+        sep = ',\n'
+
+    out.write('\n], "links": [')
+    sep = '\n'
+    for k, tip1, tip2, dists in _cluster_edges(clusters, min_size):
+        for i, j, dist in zip(tip1.tolist(), tip2.tolist(), dists.tolist()):
+            out.write(sep + json.dumps({'source': clean_name(names[i]),
+                                        'target': clean_name(names[j]),
+                                        'dist': dist}, sort_keys=True))
+            sep = ',\n'
+    out.write('\n]}\n')
+    out.flush()
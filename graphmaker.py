@@ -1,27 +1,122 @@
 import sys
 import math
+import time
+import heapq
 from datetime import date
-from Bio import Phylo
-import networkx as nx
+import numpy as np
+from treeindex import LCAIndex
+from compacttree import CompactTree
+import clustering
+import clusterstats
+import export
+from tiplabels import TipLabels
+import metrics
+
+metrics.describe('graphmaker_walk_trunk_calls', 'Reference tips searched by walk_trunk()')
+metrics.describe('graphmaker_walk_trunk_tips', 'Tips within the cutoff found by walk_trunk()')
+metrics.describe('graphmaker_nodes_visited', 'Nodes visited by walk_trunk() and nearest()')
+metrics.describe('graphmaker_list_entries', 'Tip list entries merged by tip_pairs()')
+metrics.describe('graphmaker_pairs_emitted', 'Tip pairs within the cutoff from tip_pairs()')
+metrics.describe('graphmaker_tip_pairs', 'Time spent in tip_pairs()')
+metrics.define_rate('graphmaker_pairs_per_second', 'graphmaker_pairs_emitted', 'graphmaker_tip_pairs',
+                    'Tip pairs found per second of tip_pairs()')
+
+def _merge_pairs (nodes, offset, first_child, next_sibling, branch_length,
+                  cutoff, lists, res1, res2, dists):
+    """
+    Bottom-up pass of GraphMaker.tip_pairs() over [nodes], which must be
+    in reverse preorder.  Array lists are indexed by node id - offset.
+    [lists] holds the sorted (path length, tip id) lists of nodes whose
+    subtrees are already done; pairs are appended to res1, res2, dists.
+    Returns the number of list entries carried up to a parent.
+    """
+    entries = 0
+    for node in nodes:
+        child = first_child[node-offset]
+        if child < 0:
+            lists[node] = [(0., node)]
+            continue
+        
+        merged = []
+        while child >= 0:
+            bl = branch_length[child-offset]
+            shifted = [(d+bl, tip) for d, tip in lists.pop(child) if d+bl < cutoff]
+            entries += len(shifted)
+            
+            # tips in this child against tips in earlier children
+            for d2, tip2 in shifted:
+                limit = cutoff - d2
+                for d1, tip1 in merged:
+                    if d1 >= limit:
+                        break
+                    res1.append(tip1)
+                    res2.append(tip2)
+                    dists.append(d1+d2)
+            
+            merged = list(heapq.merge(merged, shifted))
+            child = next_sibling[child-offset]
+        
+        lists[node] = merged
+    return entries
+
+
+def _to_shared (arr, typecode):
+    # copy a numpy array into shared memory for worker processes
+    import multiprocessing
+    shared = multiprocessing.RawArray(typecode, len(arr))
+    np.frombuffer(shared, dtype=arr.dtype)[:] = arr
+    return shared
+
+
+# tree arrays in shared memory, set in each worker by _init_shard_worker()
+_shard_arrays = {}
+
+def _init_shard_worker (first_child, next_sibling, branch_length):
+    _shard_arrays['first_child'] = np.frombuffer(first_child, dtype=np.int32)
+    _shard_arrays['next_sibling'] = np.frombuffer(next_sibling, dtype=np.int32)
+    _shard_arrays['branch_length'] = np.frombuffer(branch_length, dtype=np.float64)
+
+
+def _shard_pairs (task):
+    """
+    Worker for GraphMaker.tip_pairs_parallel(): pairs within the subtree
+    of nodes root..end-1, plus the tip list at the subtree root.
+    """
+    root, end, cutoff = task
+    res1, res2, dists = [], [], []
+    lists = {}
+    entries = _merge_pairs(xrange(end-1, root-1, -1), root,
+                           _shard_arrays['first_child'][root:end].tolist(),
+                           _shard_arrays['next_sibling'][root:end].tolist(),
+                           _shard_arrays['branch_length'][root:end].tolist(),
+                           cutoff, lists, res1, res2, dists)
+    return res1, res2, dists, lists[root], entries
+
 
 class GraphMaker:
     """
     Usage:
     import graphmaker as gm
-    from Bio import Phylo
-    t = Phylo.read('/Users/apoon//wip/drttree/data/foo.tree', 'newick')
+    from compacttree import load_tree
+    t = load_tree('/Users/apoon//wip/drttree/data/foo.tree')
     g = gm.GraphMaker(t)
     outfile = open('foo.dot', 'w')
     g.init_dotfile(outfile)
     g.draw_edges(outfile, 0.02)
     g.draw_nodes(outfile)
     outfile.close()
+    
+    The tree may be a Bio.Phylo tree or a CompactTree; either way it is
+    held as a CompactTree and nodes are referred to by integer id.
+    Use g.tree.to_phylo() to get a Bio.Phylo tree back.
     """
     def __init__(self, tree, tip_labels = ['PATID', 'COLDATE'],
                     origin=date(1990,1,1), scaling_factor=75., 
                     colours = {True: 'firebrick', False: 'white'},
                     shapes = {}):
-        self.tree = tree  # BioPython Tree object
+        if not isinstance(tree, CompactTree):
+            tree = CompactTree.from_phylo(tree)
+        self.tree = tree  # array-backed tree, see compacttree.py
         self.tip_labels = tip_labels
         
         self.origin = origin
@@ -31,27 +126,93 @@ class GraphMaker:
         self.colours = colours
         self.shapes = shapes
         
-        # generate dictionary of child->parent node links
-        self.parents = {}
-        for clade in self.tree.find_clades(order='level'):
-            for child in clade:
-                self.parents[child] = clade
+        # tip name -> node id
+        self.tip_ids = dict((self.tree.names[i], i) for i in self.tree.tips)
+        
+        # parse every tip label once into columns (see tiplabels.py),
+        # indexed by node id
+        self.labels = TipLabels(self.tree.names, tip_labels)
         
         # gather tips by patid
-        self.nodelist = {}
+        self.index_patients()
+        self.nodelist = {}  # patients with links, filled by draw_edges()
+        
+        # LCA index for patristic distances, built on first use
+        self.index = None
+        
+        # tree arrays as plain lists for nearest(), built on first use
+        self._lists = None
+    
+    
+    def index_patients (self):
+        """
+        Group tips by the patient ID parsed from their labels, and build:
+            patids: sorted list of patient IDs
+            patid_to_tips: patient ID -> list of tip node ids
+            tip_patient: patient number (index in patids) of every node,
+                -1 for internal nodes
+        """
+        tree = self.tree
+        patid = self.labels.patid
+        
+        self.patid_to_tips = {}
+        for tip in tree.tips.tolist():
+            self.patid_to_tips.setdefault(patid[tip], []).append(tip)
+        
+        self.patids = sorted(self.patid_to_tips.iterkeys())
+        self.tip_patient = np.full(len(tree), -1, dtype=np.int32)
+        for i, patid in enumerate(self.patids):
+            self.tip_patient[self.patid_to_tips[patid]] = i
+    
+    
+    def patient_pairs (self, cutoff):
+        """
+        Minimum patristic distance between every pair of patients that
+        have any pair of sequences within cutoff, in one pass over the
+        within-cutoff tip pairs (see tip_pairs()).
+        Returns three numpy arrays: patient numbers (index in patids) of
+        the first and second patient, with first < second, and the
+        minimum distance.
+        """
+        res1, res2, dists = self.tip_pairs(cutoff)
+        p1 = self.tip_patient[np.array(res1, dtype=np.int64)].astype(np.int64)
+        p2 = self.tip_patient[np.array(res2, dtype=np.int64)].astype(np.int64)
+        dists = np.array(dists, dtype=np.float64)
+        
+        # drop pairs within the same patient
+        keep = p1 != p2
+        lo = np.minimum(p1, p2)[keep]
+        hi = np.maximum(p1, p2)[keep]
+        dists = dists[keep]
+        
+        # shortest distance for each patient pair
+        order = np.lexsort((dists, hi, lo))
+        lo, hi, dists = lo[order], hi[order], dists[order]
+        first = np.ones(len(lo), dtype=bool)
+        first[1:] = (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+        return lo[first], hi[first], dists[first]
     
     
     def walk_up (self, tips, curnode, pathlen, cutoff):
         """
-        Recursive function for traversing up a tree.
+        Traverse up a tree from curnode, collecting tips within cutoff.
+        Uses an explicit stack so that any tree depth works.
         """
-        pathlen += curnode.branch_length
-        if pathlen < cutoff:
-            if curnode.is_terminal():
-                tips.append((curnode, pathlen))
-            else:
-                for c in curnode.clades:
-                    tips = self.walk_up(tips, c, pathlen, cutoff)
+        tree = self.tree
+        stack = [(curnode, pathlen)]
+        visited = 0
+        while stack:
+            node, pathlen = stack.pop()
+            visited += 1
+            pathlen += tree.branch_length[node]
+            if pathlen < cutoff:
+                if tree.is_tip[node]:
+                    tips.append((node, pathlen))
+                else:
+                    children = list(tree.children(node))
+                    stack.extend((c, pathlen) for c in reversed(children))
+        if metrics.enabled:
+            metrics.inc('graphmaker_nodes_visited', visited)
         return tips
     
         
@@ -59,36 +220,107 @@ class GraphMaker:
         """
         Find all tips in the tree that are within a threshold distance
         of a reference tip.
+        Returns a list of tuples (node id, distance)
         """
+        tree = self.tree
         # first go down to parent and up other branch
         tips = []
-        pathlen = curnode.branch_length # 0.0184788
-        p = self.parents[curnode]
+        pathlen = tree.branch_length[curnode] # 0.0184788
+        p = tree.parent[curnode]
         
-        for c in p.clades:
+        for c in tree.children(p):
             if c == curnode: continue
-            if c.is_terminal():
-                if pathlen + c.branch_length < cutoff:
-                    tips.append((c, pathlen + c.branch_length))
+            if tree.is_tip[c]:
+                if pathlen + tree.branch_length[c] < cutoff:
+                    tips.append((c, pathlen + tree.branch_length[c]))
             else:
                 tips.extend(self.walk_up([], c, pathlen, cutoff))
         
         # next walk down trunk until path length exceeds cutoff or hit root
-        while p in self.parents:
+        while tree.parent[p] >= 0:
             curnode = p
-            pathlen += p.branch_length # + 0.0104047
-            p = self.parents[curnode]
+            pathlen += tree.branch_length[p] # + 0.0104047
+            p = tree.parent[curnode]
             if pathlen >= cutoff: break
-            for c in p.clades:
+            for c in tree.children(p):
                 if c == curnode:
                     continue
-                if c.is_terminal():
-                    if pathlen + c.branch_length < cutoff: # + 0.0503079
-                        tips.append((c, pathlen + c.branch_length))
+                if tree.is_tip[c]:
+                    if pathlen + tree.branch_length[c] < cutoff: # + 0.0503079
+                        tips.append((c, pathlen + tree.branch_length[c]))
                 else:
                     tips.extend(self.walk_up([], c, pathlen, cutoff))
+        if metrics.enabled:
+            metrics.inc('graphmaker_walk_trunk_calls')
+            metrics.inc('graphmaker_walk_trunk_tips', len(tips))
         return tips
     
+    
+    def nearest (self, tip, cutoff=float('inf'), k=1, keep_ties=True):
+        """
+        Closest tips to [tip] from other patients, by best-first search:
+        nodes are expanded in order of path length from [tip] with a
+        priority queue, through parents as well as children, and the
+        search stops as soon as k other-patient tips have been reached.
+        Only the part of the tree closer than the answer is visited.
+        Returns a list of (node id, distance), nearest first, of at most
+        [k] tips below [cutoff] (more if keep_ties and there are ties
+        for the k-th place).
+        """
+        if self._lists is None:
+            tree = self.tree
+            self._lists = (tree.parent.tolist(), tree.first_child.tolist(),
+                           tree.next_sibling.tolist(), tree.branch_length.tolist(),
+                           self.tip_patient.tolist())
+        parent, first_child, next_sibling, branch_length, tip_patient = self._lists
+        
+        patient = tip_patient[tip]
+        res = []
+        heap = [(0., tip, -1)]  # (path length, node, node we came from)
+        visited = 0
+        while heap:
+            dist, node, prev = heapq.heappop(heap)
+            if dist >= cutoff:
+                break
+            if len(res) >= k and not (keep_ties and dist == res[-1][1]):
+                break
+            visited += 1
+            
+            if tip_patient[node] >= 0:
+                if tip_patient[node] != patient:
+                    res.append((node, dist))
+                if node != tip:
+                    continue  # a tip, nothing further this way
+            
+            # neighbours: parent and children, except where we came from
+            up = parent[node]
+            if up >= 0 and up != prev:
+                heapq.heappush(heap, (dist + branch_length[node], up, node))
+            child = first_child[node]
+            while child >= 0:
+                if child != prev:
+                    heapq.heappush(heap, (dist + branch_length[child], child, node))
+                child = next_sibling[child]
+        
+        if metrics.enabled:
+            metrics.inc('graphmaker_nodes_visited', visited)
+        return res
+    
+    
+    def nearest_other_patient (self, cutoff=float('inf'), keep_ties=True):
+        """
+        For every patient, the closest sequence from another patient to
+        their earliest sequence (missing dates last).
+        Returns a dictionary: patient ID -> (earliest tip, [(node id,
+        distance), ...]), with more than one entry only for ties.
+        """
+        coldate = self.labels.coldate
+        res = {}
+        for patid, tips in self.patid_to_tips.iteritems():
+            tip1 = min(tips, key=lambda tip: (coldate[tip] if coldate[tip] > 0 else sys.maxint, tip))
+            res[patid] = (tip1, self.nearest(tip1, cutoff, keep_ties=keep_ties))
+        return res
+    
     def init_dotfile (self, outfile):
         """
         Initialize Graphviz DOT file
@@ -99,28 +331,338 @@ class GraphMaker:
         outfile.write('\tedge [color=\"#00000070\"];\n')
         outfile.write('\toutputorder=edgesfirst;\n')
     
-    def cluster(self, cutoff):
+    def build_index (self):
+        """
+        Precompute the Euler tour and sparse table (see treeindex.LCAIndex)
+        for O(1) patristic distances.
+        """
+        self.index = LCAIndex(self.tree.parent, self.tree.branch_length)
+        return self.index
+    
+    
+    def _node_id (self, tip):
+        # accept tip names or node ids
+        if isinstance(tip, basestring):
+            return self.tip_ids[tip]
+        return tip
+    
+    
+    def distance (self, tip1, tip2):
+        """
+        Patristic distance between two tips (names or node ids) in O(1)
+        """
+        if self.index is None:
+            self.build_index()
+        return self.index.distance(self._node_id(tip1), self._node_id(tip2))
+    
+    
+    def distances (self, pairs):
+        """
+        Vectorized patristic distances for a list of (tip1, tip2) pairs.
+        Returns a numpy array.
+        """
+        if self.index is None:
+            self.build_index()
+        ids = np.array([(self._node_id(t1), self._node_id(t2)) for t1, t2 in pairs],
+                       dtype=np.int64)
+        return self.index.distances(ids)
+    
+    
+    def tip_pairs (self, cutoff, processes=1):
+        """
+        Find all pairs of tips with patristic distance below cutoff in
+        a single bottom-up pass.  Every internal node merges the tip lists
+        of its children, sorted by path length above the node, and pairs
+        tips across children only while their summed path lengths stay
+        under the cutoff.  Tips further than the cutoff from a node are
+        dropped from its list, so each pair is visited once at its most
+        recent common ancestor.
+        Nodes are numbered in preorder, so visiting ids in reverse order
+        puts children before parents.
+        Returns three lists: node ids of tip1, node ids of tip2, distances
+        
+        cutoff: maximum distance for clustering
+        processes: number of worker processes, see tip_pairs_parallel()
+        """
+        if metrics.enabled:
+            start = time.time()
+        
+        if processes > 1:
+            res1, res2, dists = self.tip_pairs_parallel(cutoff, processes)
+        else:
+            # plain lists index much faster than numpy arrays element-wise
+            res1, res2, dists = [], [], []
+            entries = _merge_pairs(xrange(len(self.tree)-1, -1, -1), 0,
+                                   self.tree.first_child.tolist(),
+                                   self.tree.next_sibling.tolist(),
+                                   self.tree.branch_length.tolist(),
+                                   cutoff, {}, res1, res2, dists)
+            if metrics.enabled:
+                metrics.inc('graphmaker_list_entries', entries)
+        
+        if metrics.enabled:
+            metrics.add_time('graphmaker_tip_pairs', time.time() - start)
+            metrics.inc('graphmaker_pairs_emitted', len(res1))
+        return res1, res2, dists
+    
+    
+    def tip_pairs_parallel (self, cutoff, processes, shards_per_process=4):
+        """
+        tip_pairs() split over a pool of processes.  The tree is cut
+        into the largest subtrees holding at most ntips/(processes *
+        shards_per_process) tips; each worker finds the pairs inside its
+        subtree and hands back the list of tips within cutoff of the
+        subtree root.  Those lists are the overlap with the rest of the
+        tree: the parent process finishes the bottom-up pass over the
+        backbone above the shards, so every pair is still found exactly
+        once.  Shard and backbone pairs are put together in the order
+        the serial pass visits nodes, so the results match the serial
+        run list for list.  Workers read the tree arrays from shared
+        memory instead of a pickled copy.
+        """
+        import multiprocessing
+        tree = self.tree
+        n = len(tree)
+        size, ntips = tree.subtree_sizes()
+        target = max(1, tree.ntips // (processes * shards_per_process))
+        
+        # shard roots: nodes small enough whose parent is not
+        small = ntips <= target
+        small_parent = np.zeros(n, dtype=bool)
+        small_parent[1:] = small[tree.parent[1:]]
+        roots = np.where(small & ~small_parent & ~tree.is_tip)[0]
+        
+        # mark every node inside a shard
+        cover = np.zeros(n+1, dtype=np.int64)
+        np.add.at(cover, roots, 1)
+        np.add.at(cover, roots + size[roots], -1)
+        in_shard = np.cumsum(cover[:n]) > 0
+        
+        shared = [_to_shared(tree.first_child, 'i'),
+                  _to_shared(tree.next_sibling, 'i'),
+                  _to_shared(tree.branch_length, 'd')]
+        pool = multiprocessing.Pool(processes, _init_shard_worker, shared)
+        try:
+            tasks = [(int(r), int(r + size[r]), cutoff) for r in roots]
+            results = pool.map(_shard_pairs, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        
+        lists = {}
+        entries = 0
+        for (root, end, cutoff), (r1, r2, d, tips, n) in zip(tasks, results):
+            lists[root] = tips
+            entries += n
+        
+        # finish the pass over the backbone above the shards; a shard
+        # covers ids root..end-1 with no backbone node among them, so its
+        # pairs go in just before the first backbone node below root
+        res1, res2, dists = [], [], []
+        first_child = tree.first_child.tolist()
+        next_sibling = tree.next_sibling.tolist()
+        branch_length = tree.branch_length.tolist()
+        shards = range(len(tasks)-1, -1, -1)  # in decreasing order of root
+        for node in np.where(~in_shard)[0][::-1].tolist():
+            while shards and tasks[shards[0]][0] > node:
+                r1, r2, d = results[shards.pop(0)][:3]
+                res1.extend(r1)
+                res2.extend(r2)
+                dists.extend(d)
+            entries += _merge_pairs((node,), 0, first_child, next_sibling, branch_length,
+                                    cutoff, lists, res1, res2, dists)
+        for i in shards:
+            r1, r2, d = results[i][:3]
+            res1.extend(r1)
+            res2.extend(r2)
+            dists.extend(d)
+        if metrics.enabled:
+            metrics.inc('graphmaker_list_entries', entries)
+        return res1, res2, dists
+    
+    
+    def pairs_within (self, cutoff, processes=1):
+        """
+        Returns a list of tuples (tip1, tip2, distance) with tip names,
+        one for each pair of tips closer than cutoff.  See tip_pairs().
+        """
+        names = self.tree.names
+        res1, res2, dists = self.tip_pairs(cutoff, processes)
+        return [(names[t1], names[t2], float(d)) for t1, t2, d in zip(res1, res2, dists)]
+    
+    
+    def cluster(self, cutoff, processes=1):
         """
         Generate clusters based on tip-to-tip (patristic) distance cutoff
         This assumes that each individual (host) is represented by one tip
         in the tree only.  See find_short_edges() for another implementation
         with multiple sequences per patient.
-        Returns a list of tuples (tip1, tip2, distance)
+        Returns a list of tuples (tip1, tip2, distance), one per pair
         
         cutoff: maximum distance for clustering
+        processes: number of worker processes (see tip_pairs_parallel)
         """
-        res = []  # a List to be returned
-        tips = self.tree.get_terminals()  # returns all tips of the tree object
-        
-        # iterate over every tip in the tree
-        for tip1 in tips:
-            # find other tips within cutoff
-            #res.update({tip1.name: {}})
-            for tip2, dist in self.walk_trunk(tip1, cutoff):
-                #res[tip1.name].update({tipname: dist})
-                res.append((tip1.name, tipname.name, dist))
+        return self.pairs_within(cutoff, processes)
     
-        return res
+    
+    def tip_edges (self, cutoff, processes=1):
+        """
+        Within-cutoff tip pairs as numpy arrays, with tips numbered
+        0..ntips-1 in the order of self.tree.tips.
+        """
+        res1, res2, dists = self.tip_pairs(cutoff, processes)
+        tips = self.tree.tips
+        return (np.searchsorted(tips, np.array(res1, dtype=np.int64)),
+                np.searchsorted(tips, np.array(res2, dtype=np.int64)),
+                np.array(dists, dtype=np.float64))
+    
+    
+    def sweep (self, cutoffs):
+        """
+        Clusters at several cutoffs for about the cost of one call to
+        cluster(): edges are found once at the largest cutoff and swept
+        in order of distance (see clustering.sweep).  Cluster labels
+        follow the order of self.tree.tips.
+        """
+        tip1, tip2, dists = self.tip_edges(max(cutoffs))
+        return clustering.sweep(self.tree.ntips, tip1, tip2, dists, cutoffs)
+    
+    
+    def cluster_stats (self, cutoff, min_size=2, flags=None,
+                       max_size=clusterstats.MEDIAN_MAX_SIZE):
+        """
+        Summary table of the clusters at [cutoff] (see
+        clusterstats.summarize), with collection dates and the fraction
+        of resistant sequences from the tip labels.
+        flags: extra columns, name -> array over self.tree.tips, e.g.
+            late diagnosis from an EpiTable
+        max_size: leave out the median distance for larger clusters
+            (None for no limit); it needs every pair of members
+        """
+        return self.sweep_stats([cutoff], min_size, flags, max_size)[0]
+    
+    
+    def sweep_stats (self, cutoffs, min_size=2, flags=None,
+                     max_size=clusterstats.MEDIAN_MAX_SIZE):
+        """
+        cluster_stats() at every cutoff.  Diameter and mean distance
+        come from the tree (clusterstats.tree_distances); pairwise
+        distances for the median within the clusters at the largest
+        cutoff are computed once and reused, since clusters at smaller
+        cutoffs nest inside them.
+        Returns a list of tables in increasing order of cutoff.
+        """
+        if self.index is None:
+            self.build_index()
+        tips = self.tree.tips
+        results = self.sweep(cutoffs)
+        a, b, lab, dist = clusterstats.pair_distances(results[-1]['labels'], tips,
+                                                      self.index, max_size)
+        columns = {'resistant': self.labels.resistant[tips]}
+        if flags:
+            columns.update(flags)
+        return [clusterstats.summarize(res['labels'], (a, b, dist),
+                                       coldate=self.labels.coldate[tips],
+                                       flags=columns, min_size=min_size,
+                                       distances=clusterstats.tree_distances(
+                                           res['labels'], tips, self.index))
+                for res in results]
+    
+    
+    def temporal (self, cutoff, windows):
+        """
+        Cluster snapshots and growth per time window (see
+        clustering.temporal_sweep), with tips dated by the COLDATE field
+        of their labels.  Labels follow the order of self.tree.tips.
+        """
+        tip1, tip2, dists = self.tip_edges(cutoff)
+        dates = self.labels.coldate[self.tree.tips]
+        return clustering.temporal_sweep(self.tree.ntips, tip1, tip2, dists, dates, windows)
+    
+    
+    def dendrogram (self, cutoff):
+        """
+        Single-linkage merge history of tips for all distances below
+        cutoff (see clustering.dendrogram).
+        """
+        tip1, tip2, dists = self.tip_edges(cutoff)
+        return clustering.dendrogram(self.tree.ntips, tip1, tip2, dists)
+    
+    
+    def add_tips (self, placements, cutoff, clusters=None, tipnames=None):
+        """
+        Add new sequences to an existing tree and clustering without
+        reclustering everything.  The new tips are attached at the given
+        branches (see CompactTree.insert_tips), only the within-cutoff
+        pairs involving new tips are searched for, and the union-find
+        of the earlier clustering is updated in place.
+        
+        placements: list of (name, node, position, pendant) from a
+            placement tool; node is a node id in this tree
+        cutoff: the cutoff used for [clusters]
+        clusters: clustering.Clusters from an earlier run; computed from
+            this tree if None
+        tipnames: names of the elements of [clusters]; defaults to the
+            tips of this tree in order (as from tip_edges())
+        
+        Returns (graphmaker, clusters, tipnames, changes)
+            graphmaker: a GraphMaker on the extended tree
+            clusters: the updated Clusters, new tips numbered after the
+                old elements in order of [placements]
+            tipnames: names of all elements
+            changes: one dictionary per cluster that received new tips:
+                status: 'new', 'grew' or 'merged'
+                old_clusters: earlier labels (of clusters with 2 or more
+                    members) that are now part of this cluster
+                new_tips: names of the new tips in it
+                size: number of members now
+        """
+        if tipnames is None:
+            tipnames = self.tree.names[self.tree.tips]
+        if clusters is None:
+            clusters = clustering.Clusters(self.tree.ntips, *self.tip_edges(cutoff))
+        old_labels = clusters.labels
+        old_sizes = clusters.sizes
+        n_old = clusters.n
+        
+        tree, new_ids = self.tree.insert_tips(placements)
+        gm = GraphMaker(tree, tip_labels=self.tip_labels, origin=self.origin,
+                        scaling_factor=self.scaling_factor, colours=self.colours,
+                        shapes=self.shapes)
+        
+        new_names = [name for name, node, position, pendant in placements]
+        element = dict((name, i) for i, name in enumerate(tipnames))
+        for k, name in enumerate(new_names):
+            element[name] = n_old + k
+        clusters.extend(len(new_names))
+        
+        # tips within cutoff of each new tip; a pair of new tips is kept
+        # only when found from the later one
+        edges = []
+        for name in new_names:
+            i = element[name]
+            for other, dist in gm.walk_trunk(gm.tip_ids[name], cutoff):
+                j = element[tree.names[other]]
+                if j < i:
+                    edges.append((i, j, dist))
+        clusters.add_edges(edges)
+        
+        groups = {}
+        for i, j, dist in edges:
+            groups.setdefault(clusters.uf.find(i), set()).update((i, j))
+        
+        changes = []
+        for root, members in groups.iteritems():
+            old = sorted(set(int(old_labels[e]) for e in members
+                             if e < n_old and old_sizes[old_labels[e]] > 1))
+            new_tips = sorted(tipnames[e] if e < n_old else new_names[e-n_old]
+                              for e in members if e >= n_old)
+            changes.append({'status': 'merged' if len(old) > 1 else 'grew' if old else 'new',
+                            'old_clusters': old,
+                            'new_tips': new_tips,
+                            'size': clusters.uf.size[root]})
+        
+        return gm, clusters, list(tipnames) + new_names, changes
 
     
 
@@ -129,102 +671,65 @@ class GraphMaker:
         """
         Find the shortest edge from the earliest sequence of a patient to a 
         any sequence from any other patient.
+        Returns a list of tuples (tip1 name, tip2 name, distance, tied)
         
         cutoff = tip-to-tip distance threshold for defining clusters
         minimize = keep only edge from earliest seq to the closest other seq
-        keep_ties = [to be used in conjunction with minimize]
-                    report all edges with the same minimum distance
+                   (see nearest())
+        keep_ties = report all edges with the same minimum distance if
+                    minimize, else all edges within cutoff; otherwise
+                    report only the first
         """
         res = []
+        names = self.tree.names
+        
+        if minimize:
+            nearest = self.nearest_other_patient(cutoff, keep_ties=keep_ties)
+            for patid in self.patids:
+                tip1, tip2 = nearest[patid]
+                if not keep_ties:
+                    tip2 = tip2[:1]
+                for t2, dist in tip2:
+                    res.append((names[tip1], names[t2], dist, len(tip2) > 1))
+            return res
         
-        for patid in self.patid_to_tips.iterkeys():
-            # get earliest sequence for this subject
+        coldate = self.labels.coldate
+        for patid in self.patids:
+            # get earliest sequence for this subject (missing dates last)
             tips = self.patid_to_tips[patid]
-            tipnames = [t.name for t in tips]
-            
-            intermed = []
-            for tip in tips:
-                tokens = tip.name.split('_')
-                coldate = tokens[self.tip_labels.index('COLDATE')]
-                intermed.append((map(int, coldate.split('-')), tip))
-            
-            #intermed = [(map(int, tip.name.split('_')[1].split('-')), tip) for tip in tips]
-            intermed.sort()
-            tip1 = intermed[0][1]
+            tip1 = min(tips, key=lambda tip: (coldate[tip] if coldate[tip] > 0 else sys.maxint, tip))
             
-            # find the shortest distance in sequences that "cluster" with this one
-            min_dist = 99999.
-            tip2 = []
-            for tipname, dist in self.walk_trunk (tip1, cutoff):
-                if tipname in tipnames:
-                    # omit sequences from same patient
-                    continue
-                if minimize and dist < min_dist:
-                    min_dist = dist
-                    tip2 = [[tipname, dist]]
-                else:
-                    tip2.append([tipname, dist])
-            
-            if tip2:
-                if keep_ties:
-                    for t2, dist in tip2:
-                        res.append((tip1.name, t2, dist, True if len(tip2)>1 else False))
-                else:
-                    # take the first match only
-                    if (tip1.name, tip2[0], min_dist, False) not in res:
-                        res.append((tip1.name, tip2[0], min_dist, False))
+            # sequences from other patients that "cluster" with this one
+            tip2 = [(tip, dist) for tip, dist in self.walk_trunk(tip1, cutoff)
+                    if self.tip_patient[tip] != self.tip_patient[tip1]]
+            if not keep_ties:
+                tip2 = tip2[:1]
+            for t2, dist in tip2:
+                res.append((names[tip1], names[t2], dist, len(tip2) > 1))
         
         return res
     
     
     def draw_edges(self, outfile, cutoff):
         """
-        Output edges to DOT file
+        Output edges to DOT file, one for every pair of patients with
+        any sequences within cutoff, weighted by their shortest distance.
         """
         self.nodelist = {} # reset dict
-        edgestr = ''
         
-        for i in range(len(self.patids)):
-            patid1 = self.patids[i]
-            tips1 = self.patid_to_tips[patid1]
-            
-            # all sequences in other subjects that cluster with ANY sequence
-            # in the current subject
-            cluster = {}
-            for t1 in tips1:
-                for partner, dist in self.walk_trunk (t1, cutoff):
-                    cluster.update ( {partner: (t1.name, dist)} )
-            
-            # loop over other subjects
-            links = []
-            for j in range(i+1, len(self.patids)):
-                patid2 = self.patids[j]
-                tips2 = self.patid_to_tips[patid2]
-                
-                # which edge is the shortest between these two subjects?
-                overlap = set(cluster.keys()).intersection(set([tip.name for tip in tips2]))
-                if overlap:
-                    min_dist = 99999.
-                    for t2 in overlap:
-                        t1, dist = cluster[t2]
-                        if dist < min_dist:
-                            min_dist = dist
-                    
-                    links.append( (min_dist, patid2) )
-            
-            if len(links) == 0: continue
-            
-            # else this patid is linked
-            if not self.nodelist.has_key(patid1):
-                self.nodelist.update( {patid1:0} )
-            
-            links.sort()
-            for dist, patid2 in links:
-                if not self.nodelist.has_key(patid2):
-                    self.nodelist.update( {patid2:0} )
-                edgestr += '\t"%s"--"%s" [len=%f];\n' % (patid1, patid2, (dist/cutoff+0.1)*4)
+        lo, hi, dists = self.patient_pairs(cutoff)
+        
+        # group edges by first patient, shortest links first
+        order = np.lexsort((hi, dists, lo))
+        edges = []
+        for i in order.tolist():
+            patid1 = self.patids[lo[i]]
+            patid2 = self.patids[hi[i]]
+            self.nodelist[patid1] = 0
+            self.nodelist[patid2] = 0
+            edges.append(export.dot_edge(patid1, patid2, {'len': (dists[i]/cutoff+0.1)*4}))
         
-        outfile.write(edgestr)
+        outfile.write(''.join(edges))
     
     
     def draw_nodes (self, outfile):
@@ -236,50 +741,33 @@ class GraphMaker:
         # only output patient sequences that have one or more links to another patient
         for patid in self.nodelist.iterkeys():
             nodes = self.patid_to_tips[patid]
-            within = []
             
             # extract the median sample date and overall Virco result
-            any_resistance = False
-            risk_factor = None
-            all_dates = []
+            # if ANY samples from the patient has resistance
+            any_resistance = bool(self.labels.resistant[nodes].any())
             
-            for node in nodes:
-                items = node.name.split('_')
-                anonid, coldate, vload = items[:3]
-                try:
-                    year, month, day = map(int, coldate.split('-'))
-                    coldate = date(year, month, day)
-                    all_dates.append (coldate)
-                except:
-                    # missing collection date
-                    pass
-                
-                # if ANY samples from the patient has resistance
-                if 'R' in items[5:26]: any_resistance = True
-                
-                # parse risk factors
-                if items[-6] == '1' and items[-5] == '1':
-                    risk_factor = 'both'
-                elif items[-6] == '1':
-                    risk_factor = 'idu'
-                elif items[-5] == '1':
-                    risk_factor = 'msm'
+            # risk factor of the last sample that has one
+            risk_factor = None
+            for risk in self.labels.risk[nodes]:
+                if risk is not None:
+                    risk_factor = risk
             
             # calculate median collection date
+            all_dates = np.sort(self.labels.coldate[nodes])
+            all_dates = all_dates[all_dates > 0]  # skip missing collection dates
             if len(all_dates) > 0:
-                all_dates.sort()
                 num_dates = len(all_dates)
                 if num_dates%2 == 0:
-                    median_date = date.fromordinal((all_dates[num_dates/2-1].toordinal() + all_dates[num_dates/2].toordinal()) / 2)
+                    median_date = date.fromordinal((all_dates[num_dates/2-1] + all_dates[num_dates/2]) / 2)
                 else:
-                    median_date = all_dates[num_dates/2]
+                    median_date = date.fromordinal(all_dates[num_dates/2])
             else:
                 median_date = date(2001,1,1) # arbitrary value
             
-            outfile.write('\t"%s" [label="", shape="%s", fillcolor="%s", width=%f];\n' % (patid, 
-                        self.shapes.get(risk_factor, 'circle'),
-                        self.colours.get(any_resistance, 'white'), 
-                        math.sqrt(median_date.toordinal()-self.origin.toordinal()) / self.scaling_factor))
+            outfile.write(export.dot_node(patid, {'label': '',
+                        'shape': self.shapes.get(risk_factor, 'circle'),
+                        'fillcolor': self.colours.get(any_resistance, 'white'),
+                        'width': math.sqrt(median_date.toordinal()-self.origin.toordinal()) / self.scaling_factor}))
         
         outfile.write('}\n')
 
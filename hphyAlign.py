@@ -2,6 +2,17 @@
 Perform pairwise alignment of sequence against a reference using the
 HyPhy shared library function AlignSequences().
 """
+import re
+import time
+import itertools
+import threading
+import metrics
+
+metrics.describe('hphyalign_alignments', 'Pairwise alignments completed')
+metrics.describe('hphyalign_dp_cells', 'Dynamic programming cells (reference x query length)')
+metrics.describe('hphyalign_align', 'Time spent in AlignSequences()')
+metrics.define_rate('hphyalign_dp_cells_per_second', 'hphyalign_dp_cells', 'hphyalign_align',
+                    'Mean DP cells per second of alignment')
 
 scoreMatrixGonnet = """\
 {{2.4,-0.6,-0.3,-0.3,0.5,0.0,-0.2,0.5,-0.8,-0.8,-1.2,-0.4,-0.7,-2.3,0.3,1.1,0.6,-3.6,-2.2,0.1,-5.0,-8.0},\
@@ -148,30 +159,47 @@ nucScoreMatrix = """\
 {-4,-4,-4,5}};
 """
 
+def settings_batch (name='alignOptions', alphabet=protAlphabet,
+                    scoreMatrix=scoreMatrixHIV25,
+                    gapOpen=40,
+                    gapOpen2=20,
+                    gapExtend=10,
+                    gapExtend2=5,
+                    noTerminalPenalty = 1):
+    """
+    HyPhy batch code that sets alignment options as an associative
+    list in the variable [name].
+    """
+    return ''.join([
+        name + " = {};",
+        name + " [\"SEQ_ALIGN_CHARACTER_MAP\"]=\""+alphabet+"\";",
+        name + " [\"SEQ_ALIGN_SCORE_MATRIX\"] = "+scoreMatrix,
+        name + " [\"SEQ_ALIGN_GAP_OPEN\"] = "+str(gapOpen)+";",
+        name + " [\"SEQ_ALIGN_GAP_OPEN2\"] = "+str(gapOpen2)+";",
+        name + " [\"SEQ_ALIGN_GAP_EXTEND\"] = "+str(gapExtend)+";",
+        name + " [\"SEQ_ALIGN_GAP_EXTEND2\"] = "+str(gapExtend2)+";",
+        name + " [\"SEQ_ALIGN_AFFINE\"] = 1;",
+        name + " [\"SEQ_ALIGN_NO_TP\"] = "+str(noTerminalPenalty)+";"])
+
+
 def change_settings (hyphy, alphabet=protAlphabet, 
                             scoreMatrix=scoreMatrixHIV25,
                             gapOpen=40,
                             gapOpen2=20,
                             gapExtend=10,
                             gapExtend2=5,
-                            noTerminalPenalty = 1):
+                            noTerminalPenalty = 1,
+                            name='alignOptions'):
     """
-    Set alignment options as associative list.
+    Set alignment options as associative list, in one call to HyPhy.
     """
-    hyphy.ExecuteBF("alignOptions = {};", False)
-    hyphy.ExecuteBF("alignOptions [\"SEQ_ALIGN_CHARACTER_MAP\"]=\""+alphabet+"\";", False)
-    hyphy.ExecuteBF("alignOptions [\"SEQ_ALIGN_SCORE_MATRIX\"] = "+scoreMatrix, False)
-    hyphy.ExecuteBF("alignOptions [\"SEQ_ALIGN_GAP_OPEN\"] = "+str(gapOpen)+";", False)
-    hyphy.ExecuteBF("alignOptions [\"SEQ_ALIGN_GAP_OPEN2\"] = "+str(gapOpen2)+";", False)
-    hyphy.ExecuteBF("alignOptions [\"SEQ_ALIGN_GAP_EXTEND\"] = "+str(gapExtend)+";", False)
-    hyphy.ExecuteBF("alignOptions [\"SEQ_ALIGN_GAP_EXTEND2\"] = "+str(gapExtend2)+";", False)
-    hyphy.ExecuteBF("alignOptions [\"SEQ_ALIGN_AFFINE\"] = 1;", False)
-    hyphy.ExecuteBF("alignOptions [\"SEQ_ALIGN_NO_TP\"] = "+str(noTerminalPenalty)+";", False)
+    hyphy.ExecuteBF(settings_batch(name, alphabet, scoreMatrix, gapOpen, gapOpen2,
+                                   gapExtend, gapExtend2, noTerminalPenalty), False)
 
     return None
 
 
-def align (hyphy, seqlist):
+def align (hyphy, seqlist, options='alignOptions'):
     """
     Use modified Gotoh algorithm in HyPhy to align a set of reference
     and query sequences passed as a list argument.
@@ -183,9 +211,19 @@ def align (hyphy, seqlist):
     input_string += '};'
     dump = hyphy.ExecuteBF (input_string)
 
-    dump = hyphy.ExecuteBF ('AlignSequences(aligned, inStr, alignOptions);', False);
+    if metrics.enabled:
+        start = time.time()
+    dump = hyphy.ExecuteBF ('AlignSequences(aligned, inStr, '+options+');', False);
     aligned = hyphy.ExecuteBF ('return aligned;', False);
     exec "d = " + aligned.sData
+    if metrics.enabled:
+        metrics.add_time('hphyalign_align', time.time() - start)
+        metrics.inc('hphyalign_alignments', len(seqlist))
+        # no generator expression here: it would clash with exec
+        cells = 0
+        for ref, query in seqlist:
+            cells += len(ref)*len(query)
+        metrics.inc('hphyalign_dp_cells', cells)
 
     res = []
     # make sure we iterate through keys in numerical order
@@ -196,16 +234,23 @@ def align (hyphy, seqlist):
 
 
 
-def pair_align (hyphy, refseq, query):
+def pair_align (hyphy, refseq, query, options='alignOptions'):
     """
     Returns a tuple containing aligned query and reference sequences using
     Smith-Wasserman algorithm.
-    alignOptions is a persistent HyPhy object set by change_settings()
+    alignOptions (or [options]) is a persistent HyPhy object set by
+    change_settings()
     """
+    if metrics.enabled:
+        start = time.time()
     dump = hyphy.ExecuteBF ('inStr={{"'+refseq+'","'+query+'"}};', False);
-    dump = hyphy.ExecuteBF ('AlignSequences(aligned, inStr, alignOptions);', False);
+    dump = hyphy.ExecuteBF ('AlignSequences(aligned, inStr, '+options+');', False);
     aligned = hyphy.ExecuteBF ('return aligned;', False);
     exec "d = " + aligned.sData
+    if metrics.enabled:
+        metrics.add_time('hphyalign_align', time.time() - start)
+        metrics.inc('hphyalign_alignments')
+        metrics.inc('hphyalign_dp_cells', len(refseq)*len(query))
 
     align_score = int(d['0']['0'])
     aligned_ref = d['0']['1']
@@ -214,7 +259,128 @@ def pair_align (hyphy, refseq, query):
     return (aligned_query, aligned_ref, align_score)
 
 
-import re
+# named option sets for Aligner, as keyword arguments to settings_batch()
+OPTION_SETS = {
+    'nucleotide': dict(alphabet=nucAlphabet, scoreMatrix=nucScoreMatrix,
+                       gapOpen=20, gapOpen2=20, gapExtend=10, gapExtend2=10,
+                       noTerminalPenalty=1),
+    'hiv25': dict(alphabet=protAlphabet, scoreMatrix=scoreMatrixHIV25),
+    'hiv5': dict(alphabet=protAlphabet, scoreMatrix=scoreMatrixHIV5),
+    'hiv50': dict(alphabet=protAlphabet, scoreMatrix=scoreMatrixHIV50),
+    'blosum': dict(alphabet=protAlphabet, scoreMatrix=scoreMatrixBLOSUM),
+    'gonnet': dict(alphabet=gonnetAlphabet, scoreMatrix=scoreMatrixGonnet)
+}
+
+
+# HyPhy keeps batch-language variables (inStr, aligned, option sets) in
+# one table per process, shared by every _THyPhy instance, so each
+# sequence of ExecuteBF calls made by an Aligner holds this lock
+_hyphy_lock = threading.Lock()
+
+# numbers the option variables of each Aligner, so that two Aligners
+# with different definitions of an option set do not share a variable
+_aligner_ids = itertools.count()
+
+
+class Aligner:
+    """
+    HyPhy session with named option sets.
+
+    Usage:
+    aligner = Aligner()
+    aquery, aref, score = aligner.pair_align(refseq, query)  # nucleotide
+    aquery, aref, score = aligner.pair_align(refprot, prot, options='hiv25')
+
+    The session is started on first use.  Each option set is sent to
+    HyPhy once and kept in its own variable, so switching between
+    option sets costs nothing.  HyPhy variables are shared by the whole
+    process, so every call holds a module-wide lock: an Aligner can be
+    shared between threads, but their alignments run one at a time.
+    Align in several processes to use more than one CPU.
+    """
+    def __init__(self, option_sets=None, default='nucleotide', cwd=None):
+        self.option_sets = dict(OPTION_SETS if option_sets is None else option_sets)
+        self.versions = dict((name, 0) for name in self.option_sets)
+        self.loaded = {}  # option set -> version last sent to HyPhy
+        self.prefix = 'alignOptions%d_' % _aligner_ids.next()
+        self.default = default
+        self.cwd = cwd
+        self.session = None
+        self.closed = False
+    
+    
+    def add_options (self, name, **kwargs):
+        """
+        Define or replace option set [name] (keyword arguments of
+        settings_batch()); it is sent to HyPhy when next used.
+        """
+        with _hyphy_lock:
+            self.option_sets[name] = kwargs
+            self.versions[name] = self.versions.get(name, 0) + 1
+    
+    
+    def _variable (self, options):
+        # HyPhy variable holding option set [options], loaded if needed,
+        # starting the session on first use; called with _hyphy_lock held
+        if self.closed:
+            raise ValueError('Aligner is closed')
+        if self.session is None:
+            import os
+            import HyPhy
+            self.session = HyPhy._THyPhy(self.cwd or os.getcwd(), 1)
+        variable = self.prefix + re.sub('[^A-Za-z0-9_]', '_', options)
+        version = self.versions[options]
+        if self.loaded.get(options) != version:
+            self.session.ExecuteBF(settings_batch(variable, **self.option_sets[options]), False)
+            self.loaded[options] = version
+        return variable
+    
+    
+    def preload (self, options=None):
+        """
+        Start the session and send option set [options] to HyPhy now
+        instead of on the first alignment.
+        """
+        with _hyphy_lock:
+            self._variable(options or self.default)
+    
+    
+    def pair_align (self, refseq, query, options=None):
+        """
+        See pair_align(); [options] is the name of an option set.
+        """
+        with _hyphy_lock:
+            variable = self._variable(options or self.default)
+            return pair_align(self.session, refseq, query, variable)
+    
+    
+    def align (self, seqlist, options=None):
+        """
+        See align(); [options] is the name of an option set.
+        """
+        with _hyphy_lock:
+            variable = self._variable(options or self.default)
+            return align(self.session, seqlist, variable)
+    
+    
+    def close (self):
+        """
+        Drop the session, once any alignment in progress is done; HyPhy
+        frees it when it is collected.  Later calls raise ValueError.
+        """
+        with _hyphy_lock:
+            self.closed = True
+            self.session = None
+
+
+def clip_insertions (aquery, aref):
+    """
+    Drop the columns of a pairwise alignment where the reference has a
+    gap, i.e. insertions in the query relative to the reference.
+    """
+    return ''.join(q for q, r in zip(aquery, aref) if r != '-')
+
+
 gap_prefix = re.compile('^[-]+')
 gap_suffix = re.compile('[-]+$')
 
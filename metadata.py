@@ -0,0 +1,213 @@
+"""
+Columnar loader for epidemiological CSV files (one row per StudyID).
+The file is read once into typed NumPy columns indexed by normalized
+StudyID, and the parsed table can be cached on disk.
+"""
+import os
+import csv
+import hashlib
+import cPickle as pickle
+from datetime import datetime
+import numpy as np
+
+
+MISSING = ('', 'NA', 'N/A', 'NULL')
+
+# part of the EpiTable cache key: bump when the attributes of EpiTable
+# change, so that older pickled tables are not loaded
+CACHE_VERSION = 1
+
+# formats tried, in order, when a column looks like dates
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%m/%d/%Y', '%d-%b-%Y', '%d%m%y')
+
+
+def normalize_id (studyid):
+    """
+    StudyIDs carry tildes in some files and tip labels but not others.
+    """
+    return studyid.strip().replace('~', '')
+
+
+def _parse_int (value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _date_format (values):
+    # first format that parses every non-missing value, or None
+    present = [v for v in values if v not in MISSING]
+    if not present:
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            for v in present:
+                datetime.strptime(v, fmt)
+            return fmt
+        except ValueError:
+            continue
+    return None
+
+
+class EpiTable:
+    """
+    Usage:
+    from metadata import EpiTable
+    epi = EpiTable.load('Vancouver_Epi.csv', cache_dir='.cache')
+    rows = epi.rows(tipnames)  # -1 where a tip has no metadata
+    sex = epi.values('Gender')[rows]
+
+    Column kinds:
+        'int': int64 values, -1 if missing
+        'date': int64 proleptic Gregorian ordinals, 0 if missing
+        'category': int32 codes into categories[name]
+        'str': object array of strings
+    """
+    def __init__(self, header, rows, id_column='StudyID', max_categories=1000):
+        self.header = header
+        columns = zip(*rows) if rows else [()] * len(header)
+
+        self.ids = np.array([normalize_id(s) for s in columns[header.index(id_column)]],
+                            dtype=object)
+        self.index = dict((s, i) for i, s in enumerate(self.ids))
+
+        self.columns = {}
+        self.kinds = {}
+        self.categories = {}
+        for name, values in zip(header, columns):
+            if name == id_column:
+                continue
+            self._add_column(name, values, max_categories)
+
+
+    def _add_column (self, name, values, max_categories):
+        # infer the type of a column of strings
+        ints = [_parse_int(v) for v in values]
+        if all(x is not None or v in MISSING for x, v in zip(ints, values)):
+            self.kinds[name] = 'int'
+            self.columns[name] = np.array([-1 if x is None else x for x in ints], dtype=np.int64)
+            return
+
+        fmt = _date_format(values)
+        if fmt is not None:
+            self.kinds[name] = 'date'
+            self.columns[name] = np.array(
+                [0 if v in MISSING else datetime.strptime(v, fmt).toordinal() for v in values],
+                dtype=np.int64)
+            return
+
+        categories = sorted(set(values))
+        if len(categories) <= max_categories:
+            self.kinds[name] = 'category'
+            self.categories[name] = categories
+            code = dict((c, i) for i, c in enumerate(categories))
+            self.columns[name] = np.array([code[v] for v in values], dtype=np.int32)
+            return
+
+        self.kinds[name] = 'str'
+        self.columns[name] = np.array(values, dtype=object)
+
+
+    @classmethod
+    def read(cls, path, **kwargs):
+        """
+        Parse a CSV file with a header row in a single pass.
+        """
+        handle = open(path, 'rU')
+        try:
+            reader = csv.reader(handle)
+            header = [h.strip() for h in reader.next()]
+            rows = [row + [''] * (len(header) - len(row)) for row in reader if row]
+        finally:
+            handle.close()
+        return cls(header, rows, **kwargs)
+
+
+    @classmethod
+    def load(cls, path, cache_dir=None, **kwargs):
+        """
+        Read a CSV file.  With [cache_dir], the parsed table is pickled
+        there and reused while the file (same path, size and
+        modification time), the read options and CACHE_VERSION are
+        unchanged.
+        """
+        if cache_dir is None:
+            return cls.read(path, **kwargs)
+
+        st = os.stat(path)
+        key = hashlib.sha1('%d:%s:%d:%r:%r' % (CACHE_VERSION, os.path.abspath(path), st.st_size,
+                                               st.st_mtime, sorted(kwargs.items()))).hexdigest()
+        cache_path = os.path.join(cache_dir, 'epi-%s.pkl' % key)
+        if os.path.exists(cache_path):
+            handle = open(cache_path, 'rb')
+            try:
+                return pickle.load(handle)
+            finally:
+                handle.close()
+
+        table = cls.read(path, **kwargs)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp = cache_path + '.tmp%d' % os.getpid()
+        handle = open(tmp, 'wb')
+        try:
+            pickle.dump(table, handle, pickle.HIGHEST_PROTOCOL)
+        finally:
+            handle.close()
+        os.rename(tmp, cache_path)
+        return table
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def rows (self, studyids):
+        """
+        Row number of each StudyID (normalized), -1 if not in the table.
+        """
+        index = self.index
+        return np.array([index.get(normalize_id(s), -1) for s in studyids], dtype=np.int64)
+
+
+    def row (self, studyid):
+        return self.index.get(normalize_id(studyid), -1)
+
+
+    def values (self, name):
+        """
+        Column [name] decoded: category strings instead of codes.
+        """
+        if self.kinds[name] == 'category':
+            return np.array(self.categories[name], dtype=object)[self.columns[name]]
+        return self.columns[name]
+
+
+    def map (self, name, func):
+        """
+        Apply [func] to every distinct value of a column (category
+        strings for categorical columns) and broadcast the results to
+        all rows.  Returns an object array.
+        """
+        col = self.columns[name]
+        if self.kinds[name] == 'category':
+            lookup = np.empty(len(self.categories[name]), dtype=object)
+            lookup[:] = [func(c) for c in self.categories[name]]
+            return lookup[col]
+        distinct, inverse = np.unique(col, return_inverse=True)
+        lookup = np.empty(len(distinct), dtype=object)
+        lookup[:] = [func(v) for v in distinct]
+        return lookup[inverse]
+
+
+    def join (self, studyids, labels, name):
+        """
+        Vectorized join of cluster membership against a column.
+        studyids: node names, e.g. tip labels
+        labels: cluster label of each node
+        Returns (labels, values) for the nodes that have metadata.
+        """
+        rows = self.rows(studyids)
+        found = rows >= 0
+        return np.asarray(labels)[found], self.values(name)[rows[found]]
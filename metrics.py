@@ -0,0 +1,199 @@
+"""
+Counters and timers for the hot paths (alignment, FASTA parsing, tip
+pair search), exported as a JSON snapshot or a Prometheus text file.
+
+Instrumentation is off by default.  Instrumented code checks
+metrics.enabled before doing any work, so the cost when disabled is
+one attribute lookup per call site:
+
+    import metrics
+    metrics.enable()
+    metrics.start_progress(sys.stderr, interval=30)
+    ...
+    metrics.write_json('metrics.json')
+"""
+import os
+import re
+import sys
+import time
+import json
+import threading
+from contextlib import contextmanager
+
+
+enabled = False
+
+counters = {}  # name -> value
+timers = {}  # name -> [number of timed calls, total seconds]
+rates = {}  # name -> (counter, timer), reported as counter per timed second
+help_text = {}  # name -> description, for Prometheus HELP lines
+
+_started = time.time()
+_progress = None
+
+
+def enable (on=True):
+    global enabled, _started
+    enabled = on
+    if on:
+        _started = time.time()
+
+
+def reset ():
+    global _started
+    counters.clear()
+    timers.clear()
+    _started = time.time()
+
+
+def describe (name, text):
+    help_text[name] = text
+
+
+def define_rate (name, counter, timer, text=None):
+    """
+    Report [counter] divided by the time spent in [timer] as [name],
+    e.g. DP cells per second of alignment.
+    """
+    rates[name] = (counter, timer)
+    if text:
+        help_text[name] = text
+
+
+def inc (name, n=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+
+def add_time (name, seconds, calls=1):
+    if enabled:
+        t = timers.get(name)
+        if t is None:
+            timers[name] = [calls, seconds]
+        else:
+            t[0] += calls
+            t[1] += seconds
+
+
+@contextmanager
+def timer (name):
+    """
+    Time the enclosed block (a no-op when disabled).
+    """
+    if not enabled:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - start)
+
+
+def snapshot ():
+    """
+    Current values as a dictionary.
+    """
+    res = {'uptime_seconds': time.time() - _started,
+           'counters': dict(counters),
+           'timers': dict((name, {'calls': t[0], 'seconds': t[1]})
+                          for name, t in timers.iteritems()),
+           'rates': {}}
+    for name, (counter, timer_name) in rates.iteritems():
+        seconds = timers.get(timer_name, [0, 0.])[1]
+        if seconds > 0:
+            res['rates'][name] = counters.get(counter, 0) / seconds
+    return res
+
+
+def write_json (path):
+    handle = open(path, 'w')
+    try:
+        json.dump(snapshot(), handle, indent=2, sort_keys=True)
+        handle.write('\n')
+    finally:
+        handle.close()
+
+
+_metric_name = re.compile('[^a-zA-Z0-9_:]')
+
+def _prom_name (name):
+    return _metric_name.sub('_', name)
+
+
+def prometheus ():
+    """
+    Current values in the Prometheus text exposition format, e.g. for
+    the node_exporter textfile collector.
+    """
+    lines = []
+    def metric(name, kind, value, text):
+        name = _prom_name(name)
+        if text:
+            lines.append('# HELP %s %s' % (name, text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        lines.append('%s %r' % (name, value))
+
+    snap = snapshot()
+    for name in sorted(snap['counters']):
+        metric(name + '_total', 'counter', snap['counters'][name], help_text.get(name))
+    for name in sorted(snap['timers']):
+        t = snap['timers'][name]
+        metric(name + '_seconds_total', 'counter', t['seconds'], help_text.get(name))
+        metric(name + '_calls_total', 'counter', t['calls'], None)
+    for name in sorted(snap['rates']):
+        metric(name, 'gauge', snap['rates'][name], help_text.get(name))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus (path):
+    # write then rename, so that a collector never reads a partial file
+    tmp = path + '.tmp'
+    handle = open(tmp, 'w')
+    try:
+        handle.write(prometheus())
+    finally:
+        handle.close()
+    os.rename(tmp, path)
+
+
+def progress_line ():
+    snap = snapshot()
+    items = ['%s=%d' % (name, value) for name, value in sorted(snap['counters'].iteritems())]
+    items += ['%s=%.1f' % (name, value) for name, value in sorted(snap['rates'].iteritems())]
+    return '[%8.1fs] %s' % (snap['uptime_seconds'], ' '.join(items))
+
+
+class _Progress (threading.Thread):
+    # background thread writing a progress line every [interval] seconds
+    def __init__(self, handle, interval):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.handle = handle
+        self.interval = interval
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.handle.write(progress_line() + '\n')
+            self.handle.flush()
+
+
+def start_progress (handle=sys.stderr, interval=30.):
+    """
+    Enable instrumentation and print a progress line to [handle] every
+    [interval] seconds until stop_progress().
+    """
+    global _progress
+    enable()
+    stop_progress()
+    _progress = _Progress(handle, interval)
+    _progress.start()
+
+
+def stop_progress ():
+    global _progress
+    if _progress is not None:
+        _progress.done.set()
+        _progress.join()
+        _progress = None
@@ -0,0 +1,307 @@
+"""
+Neighbour-joining trees from aligned FASTA, to go straight from the
+output of align.py to GraphMaker without an external tree builder.
+
+Usage:
+from njtree import read_alignment, distance_matrix, nj_tree
+names, codes = read_alignment('aligned.fa')
+tree = nj_tree(distance_matrix(codes), names)  # a CompactTree
+tree.write_newick('aligned.tree')
+"""
+import numpy as np
+from compacttree import CompactTree
+
+
+def read_alignment (path):
+    """
+    Read aligned FASTA into tip names and an (ntaxa, nsites) uint8
+    array of upper-case character codes.
+    """
+    from seqUtils import iter_fasta
+    handle = open(path, 'rU')
+    try:
+        names, seqs = [], []
+        for h, s in iter_fasta(handle):
+            names.append(h)
+            seqs.append(s)
+    finally:
+        handle.close()
+    return names, encode(seqs)
+
+
+def encode (seqs):
+    """
+    Pack equal-length sequences into an (n, nsites) uint8 array.
+    """
+    nsites = len(seqs[0]) if seqs else 0
+    for s in seqs:
+        if len(s) != nsites:
+            raise ValueError('Sequences are not aligned (lengths %d and %d)' % (nsites, len(s)))
+    codes = np.frombuffer(''.join(seqs).upper(), dtype=np.uint8)
+    return codes.reshape(len(seqs), nsites)
+
+
+def distance_matrix (codes, model='jc69', block=1024, dtype=np.float64, processes=1):
+    """
+    Pairwise distances between aligned sequences, counting only sites
+    where both have an unambiguous nucleotide (A, C, G or T).  Matches
+    are counted with one matrix product per nucleotide, in blocks of
+    [block] rows; the result is the only n x n array made.
+
+    model: 'p' for the proportion of differing sites, 'jc69' for the
+        Jukes-Cantor correction (saturated pairs get the largest
+        finite distance)
+    processes: with more than one, blocks of [block] x [block] pairs
+        are shared among worker processes, which read the sequences
+        from shared memory (see sharedalign.py)
+    """
+    if model not in ('p', 'jc69'):
+        raise ValueError('Unknown distance model: %s' % model)
+    n = len(codes)
+    dist = np.empty((n, n), dtype=dtype)
+    if processes > 1:
+        from sharedalign import SharedAlignment, pair_tiles, imap_tiles
+        with SharedAlignment.publish(codes) as shared:
+            tiles = pair_tiles(n, block)
+            for (r0, r1, c0, c1), d in zip(tiles, imap_tiles(_tile_distances, shared, tiles, processes)):
+                dist[r0:r1, c0:c1] = d
+                dist[c0:c1, r0:r1] = d.T
+    else:
+        indicators = [(codes == ord(nuc)).astype(np.float32) for nuc in 'ACGT']
+        valid = indicators[0] + indicators[1] + indicators[2] + indicators[3]
+        for start in xrange(0, n, block):
+            stop = min(start+block, n)
+            same = np.zeros((stop-start, n), dtype=np.float32)
+            for x in indicators:
+                same += np.dot(x[start:stop], x.T)
+            sites = np.dot(valid[start:stop], valid.T)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dist[start:stop] = 1. - same / sites
+
+    # transform in place, [block] rows at a time, so that no temporaries
+    # the size of the matrix are made; pairs without shared sites, or
+    # saturated, are marked -inf and then get the largest distance
+    largest = -np.inf
+    missing = False
+    mask = np.empty((min(block, n), n), dtype=bool)
+    for start in xrange(0, n, block):
+        rows = dist[start:(start+block)]
+        bad = mask[:len(rows)]
+        if model == 'jc69':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                np.divide(rows, 0.75, out=rows)
+                np.subtract(1., rows, out=rows)
+                np.log(rows, out=rows)
+            rows *= -0.75
+        np.isfinite(rows, out=bad)
+        np.logical_not(bad, out=bad)
+        if bad.any():
+            missing = True
+            np.copyto(rows, -np.inf, where=bad)
+        if len(rows):
+            largest = max(largest, rows.max())
+
+    if missing:
+        if largest == -np.inf:
+            largest = 1.
+        for start in xrange(0, n, block):
+            rows = dist[start:(start+block)]
+            bad = mask[:len(rows)]
+            np.isneginf(rows, out=bad)
+            np.copyto(rows, largest, where=bad)
+    np.fill_diagonal(dist, 0.)
+    return dist
+
+
+def _tile_distances (alignment, tile):
+    # proportion of differing sites between a block of rows and a block
+    # of columns, NaN without shared sites; run in worker processes
+    r0, r1, c0, c1 = tile
+    rows = alignment.codes[r0:r1]
+    cols = alignment.codes[c0:c1]
+    same = np.zeros((r1-r0, c1-c0), dtype=np.float32)
+    valid_rows = np.zeros(rows.shape, dtype=np.float32)
+    valid_cols = np.zeros(cols.shape, dtype=np.float32)
+    for nuc in 'ACGT':
+        x = (rows == ord(nuc)).astype(np.float32)
+        y = (cols == ord(nuc)).astype(np.float32)
+        same += np.dot(x, y.T)
+        valid_rows += x
+        valid_cols += y
+    sites = np.dot(valid_rows, valid_cols.T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1. - same / sites
+
+
+def _lower32 (x):
+    # float32 copy of [x] one step below the nearest value, so that
+    # bounds read from it never exceed the float64 values
+    return np.nextafter(x.astype(np.float32), np.float32(-np.inf))
+
+
+def nj_tree (dist, names, chunk=16, block=1024, overwrite=False):
+    """
+    Neighbour-joining tree from a distance matrix, as a CompactTree
+    rooted on the last join.
+
+    The pair to join minimises Q(i,j) = D(i,j) - u(i) - u(j), with
+    u(i) = r(i)/(m-2) for m remaining nodes.  As in RapidNJ, every node
+    keeps its row of D sorted, and rows are scanned from the smallest
+    distance only while D(i,j) - u(i) - max(u) can still beat the best
+    Q found, so most of the matrix is never looked at.  Rows are scanned
+    [chunk] columns at a time, all rows at once.
+
+    A row holds the nodes that existed when it was made; a pair is
+    found in the row of whichever node is newer.  Joined nodes stay in
+    old rows and are skipped, and the rows are rebuilt (and D compacted)
+    whenever the number of nodes has halved.
+
+    The sorted rows keep int32 node ids and float32 distances rounded
+    down, which are only used to bound the scan; Q is computed from the
+    float64 matrix.  Memory is about 16 bytes per matrix cell (D plus
+    the sorted rows; rows are sorted [block] at a time), plus the
+    caller's matrix unless [overwrite] lets a float64 [dist] be used as
+    D and modified in place: 6.4 GB for 20,000 taxa, 14.4 GB for 30,000.
+    """
+    if not (overwrite and isinstance(dist, np.ndarray) and dist.dtype == np.float64):
+        dist = np.array(dist, dtype=np.float64)
+    n = len(dist)
+    if n < 2:
+        return CompactTree([-1] * n, [0.] * n, list(names))
+
+    nnodes = 2*n - 1  # tips, joins, and the root
+    sentinel = nnodes  # node id padding sorted rows; never alive
+    parent = np.full(nnodes, -1, dtype=np.int64)
+    branch_length = np.zeros(nnodes, dtype=np.float64)
+    slot_of = np.full(nnodes+1, -1, dtype=np.int64)  # node -> row of D, -1 if joined
+    slot_of[:n] = np.arange(n)
+    node_of = np.arange(n)  # row of D -> node
+    alive = np.ones(n, dtype=bool)
+    r = dist.sum(axis=1)
+    m = n
+    next_node = n
+
+    def rebuild(dist, r, node_of, alive):
+        # compact D to the live rows and sort every row, [block] rows at
+        # a time; one column of padding so that bounds can always be read
+        live = np.flatnonzero(alive)
+        if len(live) < len(dist):
+            dist = dist[np.ix_(live, live)]
+        node_of = node_of[live]
+        m = len(live)
+        slot_of[node_of] = np.arange(m)
+        row_val = np.full((m, m+1), np.inf, dtype=np.float32)
+        row_id = np.full((m, m+1), sentinel, dtype=np.int32)
+        for start in xrange(0, m, block):
+            stop = min(start+block, m)
+            d = dist[start:stop].copy()
+            d[np.arange(stop-start), np.arange(start, stop)] = np.inf
+            order = np.argsort(d, axis=1, kind='mergesort')[:, :m-1]
+            vals = d[np.arange(stop-start)[:, None], order]
+            row_val[start:stop, :m-1] = _lower32(vals)
+            row_id[start:stop, :m-1] = np.where(np.isinf(vals), sentinel, node_of[order])
+        return dist, r[live], node_of, np.ones(m, dtype=bool), row_val, row_id
+
+    dist, r, node_of, alive, row_val, row_id = rebuild(dist, r, node_of, alive)
+    rebuild_at = m // 2
+
+    while m > 2:
+        u = r / (m-2)
+        act = np.flatnonzero(alive)
+        umax = u[act].max()
+
+        best = np.inf
+        bi = bj = -1
+        rows = act
+        start = 0
+        width = row_val.shape[1]
+        while len(rows) and start < width - 1:
+            stop = min(start+chunk, width-1)
+            cols = slot_of[row_id[rows, start:stop]]
+            q = row_val[rows, start:stop] - u[rows][:, None] - u[cols]
+            q[cols < 0] = np.inf
+            k = q.argmin()
+            if q.flat[k] < best:
+                # q is a lower bound; take Q from D for the entries that
+                # could beat both the best so far and entry k
+                qk = dist[rows[k // q.shape[1]], cols.flat[k]] - u[rows[k // q.shape[1]]] - u[cols.flat[k]]
+                cand = np.flatnonzero((q <= qk) & (q < best))
+                ci = rows[cand // q.shape[1]]
+                cj = cols.flat[cand]
+                exact = dist[ci, cj] - u[ci] - u[cj]
+                k = exact.argmin()
+                if exact[k] < best:
+                    best = exact[k]
+                    bi = ci[k]
+                    bj = cj[k]
+            # rows whose next entry could still give a smaller Q
+            bound = row_val[rows, stop] - u[rows] - umax
+            rows = rows[bound < best]
+            start = stop
+
+        # join slots bi and bj into a new node held in slot bi
+        a, b = node_of[bi], node_of[bj]
+        dij = dist[bi, bj]
+        li = 0.5*dij + (r[bi]-r[bj]) / (2.*(m-2))
+        li = min(max(li, 0.), dij)
+        c = next_node
+        next_node += 1
+        parent[a] = parent[b] = c
+        branch_length[a] = li
+        branch_length[b] = dij - li
+
+        others = act[(act != bi) & (act != bj)]
+        dnew = 0.5 * (dist[bi, others] + dist[bj, others] - dij)
+        r[others] += dnew - dist[bi, others] - dist[bj, others]
+        r[bi] = dnew.sum()
+        dist[bi, others] = dnew
+        dist[others, bi] = dnew
+        alive[bj] = False
+        slot_of[a] = slot_of[b] = -1
+        slot_of[c] = bi
+        node_of[bi] = c
+        m -= 1
+
+        # sorted row for the new node
+        order = np.argsort(dnew, kind='mergesort')
+        row_val[bi] = np.inf
+        row_id[bi] = sentinel
+        row_val[bi, :len(order)] = _lower32(dnew[order])
+        row_id[bi, :len(order)] = node_of[others[order]]
+        row_val[bj] = np.inf
+
+        if m <= rebuild_at and m > 2:
+            dist, r, node_of, alive, row_val, row_id = rebuild(dist, r, node_of, alive)
+            rebuild_at = m // 2
+
+    # root the tree on the last edge, halfway along
+    i, j = np.flatnonzero(alive)
+    a, b = node_of[i], node_of[j]
+    root = next_node
+    parent[a] = parent[b] = root
+    branch_length[a] = branch_length[b] = 0.5 * dist[i, j]
+
+    return _to_compact(parent, branch_length, list(names), root)
+
+
+def _to_compact (parent, branch_length, names, root):
+    # renumber nodes in preorder from [root]
+    children = [[] for i in xrange(len(parent))]
+    for node, p in enumerate(parent.tolist()):
+        if p >= 0:
+            children[p].append(node)
+
+    order = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        order.append(node)
+        stack.extend(reversed(children[node]))
+
+    new_id = np.empty(len(parent), dtype=np.int64)
+    new_id[order] = np.arange(len(order))
+    order = np.array(order)
+    new_parent = np.where(parent[order] >= 0, new_id[parent[order]], -1)
+    n = len(names)
+    return CompactTree(new_parent, branch_length[order],
+                       [names[node] if node < n else None for node in order.tolist()])
@@ -0,0 +1,402 @@
+"""
+Single entry point for the clustering pipeline, replacing the
+hard-coded file names and cutoffs in align.py and clustergraph.py:
+
+    python pipeline.py qc seqs.fasta -o passed.fasta --report qc.csv
+    python pipeline.py align passed.fasta -o aligned.fa
+    python pipeline.py tree aligned.fa -o tree.nwk
+    python pipeline.py distance tree.nwk -c 0.02 -o edges.csv
+    python pipeline.py cluster tree.nwk -c 0.02 -o clusters.csv
+    python pipeline.py export tree.nwk -c 0.02 --epi epi.csv -o clusters.dot
+
+cluster and export take either a tree or an edge list written by
+distance (--edges).  With --profile, wall time, CPU time, peak memory
+and throughput of every stage are written to a JSON report; --metrics
+and --progress expose the counters in metrics.py.
+"""
+import sys
+import csv
+import argparse
+from profiling import Profiler
+import metrics
+
+
+def cmd_qc (args, prof):
+    """
+    Screen raw sequences before alignment; write the sequences that pass
+    and a CSV report of QC measures and reasons for rejection.
+    """
+    import qc
+    from seqUtils import iter_fasta, write_fasta, open_buffered
+    with prof.stage('read') as stage:
+        handle = open(args.fasta, 'rU')
+        records = list(iter_fasta(handle))
+        handle.close()
+        stage['items'] = len(records)
+    with prof.stage('qc') as stage:
+        passed, stats, reasons = qc.screen(records, min_length=args.min_length,
+                                           max_mixtures=args.max_mixtures,
+                                           max_gap_n_fraction=args.max_gap_n_fraction,
+                                           max_n_run=args.max_n_run, max_stops=args.max_stops,
+                                           frame=args.frame)
+        stage['items'] = int(stats['length'].sum())
+    with prof.stage('write'):
+        outfile = open_buffered(args.output)
+        write_fasta(passed, outfile)
+        outfile.close()
+        if args.report:
+            outfile = open(args.report, 'w')
+            qc.write_report(outfile, [h for h, s in records], stats, reasons)
+            outfile.close()
+    sys.stderr.write('%d of %d sequences passed QC\n' % (len(passed), len(records)))
+
+
+def cmd_align (args, prof):
+    """
+    Align every sequence against the first (or --ref) and clip out
+    insertions relative to it.
+    """
+    import hphyAlign
+    from seqUtils import iter_fasta, write_fasta, open_buffered
+
+    with prof.stage('hyphy_init'):
+        aligner = hphyAlign.Aligner()
+        aligner.add_options('nucleotide', alphabet=hphyAlign.nucAlphabet,
+                            scoreMatrix=hphyAlign.nucScoreMatrix,
+                            gapOpen=args.gap_open, gapOpen2=args.gap_open,
+                            gapExtend=args.gap_extend, gapExtend2=args.gap_extend,
+                            noTerminalPenalty=1)
+        aligner.preload()
+
+    handle = open(args.fasta, 'rU')
+    records = iter_fasta(handle)
+    if args.ref:
+        ref = open(args.ref, 'rU')
+        nameref, refseq = iter_fasta(ref).next()
+        ref.close()
+    else:
+        nameref, refseq = records.next()
+    refseq = refseq.replace('-', '')
+
+    def aligned(stage):
+        for header, sequence in records:
+            aquery, aref, ascore = aligner.pair_align(refseq, sequence.replace('-', ''))
+            stage['items'] += 1
+            yield header, hphyAlign.clip_insertions(aquery, aref)
+
+    outfile = open_buffered(args.output)
+    try:
+        with prof.stage('align') as stage:
+            write_fasta(aligned(stage), outfile)
+    finally:
+        outfile.close()
+        handle.close()
+
+
+def cmd_tree (args, prof):
+    """
+    Build a neighbour-joining tree from aligned FASTA and write it as
+    Newick.
+    """
+    from njtree import read_alignment, distance_matrix, nj_tree
+    with prof.stage('read_alignment') as stage:
+        names, codes = read_alignment(args.fasta)
+        stage['items'] = len(names)
+    with prof.stage('distance_matrix') as stage:
+        dist = distance_matrix(codes, model=args.model, processes=args.processes)
+        stage['items'] = len(names) * (len(names)-1) // 2
+    with prof.stage('nj') as stage:
+        tree = nj_tree(dist, names, overwrite=True)
+        stage['items'] = len(names)
+    with prof.stage('write'):
+        tree.write_newick(args.output)
+
+
+def _load_tree (args, prof):
+    from compacttree import load_tree
+    with prof.stage('load_tree') as stage:
+        tree = load_tree(args.tree, cache_dir=args.cache_dir)
+        stage['items'] = tree.ntips
+    return tree
+
+
+def _tree_edges (args, prof):
+    # (tip names, tip1, tip2, dists) from the tree
+    from graphmaker import GraphMaker
+    tree = _load_tree(args, prof)
+    with prof.stage('tip_pairs') as stage:
+        gm = GraphMaker(tree, tip_labels=[])
+        tip1, tip2, dists = gm.tip_edges(args.cutoff, args.processes)
+        stage['items'] = len(dists)
+    return gm.tree.names[gm.tree.tips], tip1, tip2, dists
+
+
+def _read_edges (args, prof):
+    # (tip names, tip1, tip2, dists) from an edge list written by distance;
+    # every tip named in the file is kept, so tips without edges within
+    # the cutoff remain as singletons
+    import numpy as np
+    with prof.stage('read_edges') as stage:
+        handle = open(args.edges, 'rU')
+        try:
+            reader = csv.reader(handle)
+            reader.next()
+            names = set()
+            rows = []
+            for row in reader:
+                if not row:
+                    continue
+                names.add(row[0])
+                if len(row) > 2 and row[1]:
+                    names.add(row[1])
+                    if float(row[2]) < args.cutoff:
+                        rows.append(row)
+        finally:
+            handle.close()
+        stage['items'] = len(rows)
+
+    names = sorted(names)
+    index = dict((name, i) for i, name in enumerate(names))
+    tip1 = np.array([index[row[0]] for row in rows], dtype=np.int64)
+    tip2 = np.array([index[row[1]] for row in rows], dtype=np.int64)
+    dists = np.array([float(row[2]) for row in rows], dtype=np.float64)
+    return np.array(names, dtype=object), tip1, tip2, dists
+
+
+def _edges (args, prof):
+    if args.edges:
+        return _read_edges(args, prof)
+    if not args.tree:
+        sys.exit('ERROR: expecting a tree file or --edges')
+    return _tree_edges(args, prof)
+
+
+def _clusters (args, prof):
+    from clustering import Clusters
+    names, tip1, tip2, dists = _edges(args, prof)
+    with prof.stage('clusters') as stage:
+        clusters = Clusters(len(names), tip1, tip2, dists)
+        stage['items'] = len(dists)
+    return names, clusters
+
+
+def cmd_distance (args, prof):
+    """
+    Write all pairs of tips within the patristic distance cutoff, then
+    one row with empty tip2 and dist for each tip without such a pair,
+    so that clusters read back from the file keep their singletons.
+    """
+    import numpy as np
+    names, tip1, tip2, dists = _tree_edges(args, prof)
+    outfile = open(args.output, 'w')
+    try:
+        with prof.stage('write') as stage:
+            # quoted as _read_edges() expects, for names with commas
+            writer = csv.writer(outfile, lineterminator='\n')
+            writer.writerow(('tip1', 'tip2', 'dist'))
+            for i, j, dist in zip(tip1.tolist(), tip2.tolist(), dists.tolist()):
+                writer.writerow((names[i], names[j], repr(dist)))
+            paired = np.zeros(len(names), dtype=bool)
+            paired[tip1] = paired[tip2] = True
+            for i in np.flatnonzero(~paired).tolist():
+                writer.writerow((names[i], '', ''))
+            stage['items'] = len(dists)
+    finally:
+        outfile.close()
+
+
+def cmd_cluster (args, prof):
+    """
+    Write cluster membership: one row per node with its cluster label
+    and cluster size, largest clusters first.
+    """
+    names, clusters = _clusters(args, prof)
+    outfile = open(args.output, 'w')
+    try:
+        with prof.stage('write') as stage:
+            writer = csv.writer(outfile, lineterminator='\n')
+            writer.writerow(('name', 'cluster', 'size'))
+            sizes = clusters.sizes
+            for k in clusters.by_size(args.min_size):
+                for i in clusters.members(k).tolist():
+                    writer.writerow((names[i], k, sizes[k]))
+                    stage['items'] += 1
+    finally:
+        outfile.close()
+
+
+def cmd_stats (args, prof):
+    """
+    Write a table of per-cluster statistics (see clusterstats.py).
+    """
+    import clusterstats
+    from graphmaker import GraphMaker
+    tree = _load_tree(args, prof)
+    with prof.stage('cluster_stats') as stage:
+        gm = GraphMaker(tree, tip_labels=args.tip_labels.split(','))
+        max_size = args.max_size if args.max_size > 0 else None
+        table = gm.cluster_stats(args.cutoff, min_size=args.min_size, max_size=max_size)
+        stage['items'] = len(table['cluster'])
+    if max_size is not None:
+        skipped = int((table['size'] > max_size).sum())
+        if skipped:
+            sys.stderr.write('median_dist left out for %d clusters larger than '
+                             '--max-size %d\n' % (skipped, max_size))
+    outfile = open(args.output, 'w')
+    try:
+        with prof.stage('write'):
+            if args.format == 'csv':
+                clusterstats.write_csv(outfile, table)
+            else:
+                clusterstats.write_text(outfile, table)
+    finally:
+        outfile.close()
+
+
+def cmd_export (args, prof):
+    """
+    Write clusters as a DOT, GraphML, JSON or CSV/binary edge list,
+    with nodes styled from an epidemiological CSV file if given.
+    """
+    import export
+    names, clusters = _clusters(args, prof)
+
+    style = None
+    if args.epi:
+        from metadata import EpiTable
+        with prof.stage('load_epi') as stage:
+            epidata = EpiTable.load(args.epi, cache_dir=args.cache_dir)
+            style = export.EpiNodeStyle(epidata)
+            stage['items'] = len(epidata)
+
+    binary = args.format == 'binary'
+    outfile = open(args.output, 'wb' if binary else 'w')
+    try:
+        with prof.stage('write') as stage:
+            if args.format == 'dot':
+                cutoff = args.cutoff
+                export.write_dot(outfile, clusters, names, min_size=args.min_size, style=style,
+                                 edge_attrs=lambda dist: {'len': dist/cutoff+0.5})
+            elif args.format == 'graphml':
+                export.write_graphml(outfile, clusters, names, min_size=args.min_size, style=style,
+                                     keys=('label', 'fillcolor', 'shape') if style else ())
+            elif args.format == 'json':
+                export.write_json(outfile, clusters, names, min_size=args.min_size, style=style)
+            else:
+                export.write_edgelist(outfile, clusters, names, min_size=args.min_size, binary=binary)
+            stage['items'] = int((clusters.sizes[clusters.labels] >= args.min_size).sum())
+    finally:
+        outfile.close()
+
+
+def parse_args (argv=None):
+    parser = argparse.ArgumentParser(description='Phylogenetic clustering pipeline.')
+    parser.add_argument('--profile', metavar='JSON',
+                        help='write per-stage timing and memory use to this file')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write hot-path counters to this file (Prometheus text if it '
+                             'ends in .prom, else JSON)')
+    parser.add_argument('--progress', metavar='SECONDS', type=float,
+                        help='print a progress line to stderr this often')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('qc', help='screen sequences before alignment')
+    p.add_argument('fasta', help='input FASTA file')
+    p.add_argument('-o', '--output', required=True, help='FASTA file of sequences that pass')
+    p.add_argument('--report', help='CSV file of QC measures for every sequence')
+    p.add_argument('--min-length', type=int, default=500)
+    p.add_argument('--max-mixtures', type=int, default=50)
+    p.add_argument('--max-gap-n-fraction', type=float, default=0.1)
+    p.add_argument('--max-n-run', type=int, default=100)
+    p.add_argument('--max-stops', type=int, default=0)
+    p.add_argument('--frame', type=int, default=0, help='reading frame for stop codons')
+    p.set_defaults(func=cmd_qc)
+
+    p = commands.add_parser('align', help='align sequences against a reference')
+    p.add_argument('fasta', help='input FASTA file')
+    p.add_argument('-o', '--output', required=True, help='output FASTA file')
+    p.add_argument('--ref', help='FASTA file with the reference (default: first sequence)')
+    p.add_argument('--gap-open', type=int, default=20)
+    p.add_argument('--gap-extend', type=int, default=10)
+    p.set_defaults(func=cmd_align)
+
+    p = commands.add_parser('tree', help='neighbour-joining tree from aligned sequences')
+    p.add_argument('fasta', help='aligned FASTA file')
+    p.add_argument('-o', '--output', required=True, help='output Newick file')
+    p.add_argument('--model', default='jc69', choices=['jc69', 'p'],
+                   help='distance: Jukes-Cantor (default) or proportion of differing sites')
+    p.add_argument('-p', '--processes', type=int, default=1,
+                   help='worker processes for the distance matrix')
+    p.set_defaults(func=cmd_tree)
+
+    def add_tree_args(p, edges=True):
+        if edges:
+            p.add_argument('tree', nargs='?', help='Newick tree file')
+            p.add_argument('--edges', help='edge list from the distance command instead of a tree')
+        else:
+            p.add_argument('tree', help='Newick tree file')
+        p.add_argument('-c', '--cutoff', type=float, default=0.02,
+                       help='patristic distance cutoff (default 0.02)')
+        p.add_argument('-p', '--processes', type=int, default=1,
+                       help='worker processes for the pair search')
+        p.add_argument('--cache-dir', help='directory for parsed tree and CSV caches')
+
+    p = commands.add_parser('distance', help='tip pairs within the cutoff')
+    add_tree_args(p, edges=False)
+    p.add_argument('-o', '--output', required=True, help='output CSV file')
+    p.set_defaults(func=cmd_distance)
+
+    p = commands.add_parser('cluster', help='cluster membership')
+    add_tree_args(p)
+    p.add_argument('-o', '--output', required=True, help='output CSV file')
+    p.add_argument('--min-size', type=int, default=1)
+    p.set_defaults(func=cmd_cluster)
+
+    p = commands.add_parser('stats', help='per-cluster statistics')
+    add_tree_args(p, edges=False)
+    p.add_argument('-o', '--output', required=True, help='output file')
+    p.add_argument('-f', '--format', default='csv', choices=['csv', 'text'])
+    p.add_argument('--min-size', type=int, default=2)
+    p.add_argument('--max-size', type=int, default=1000,
+                   help='leave out the median distance, which needs every pair '
+                        'of members, for larger clusters; 0 for no limit '
+                        '(default %(default)s)')
+    p.add_argument('--tip-labels', default='PATID,COLDATE',
+                   help='fields of the tip labels, separated by commas')
+    p.set_defaults(func=cmd_stats)
+
+    p = commands.add_parser('export', help='write clusters as a graph')
+    add_tree_args(p)
+    p.add_argument('-o', '--output', required=True, help='output file')
+    p.add_argument('-f', '--format', default='dot',
+                   choices=['dot', 'graphml', 'json', 'csv', 'binary'])
+    p.add_argument('--epi', help='epidemiological CSV file for node styling')
+    p.add_argument('--min-size', type=int, default=5)
+    p.set_defaults(func=cmd_export)
+
+    return parser.parse_args(argv)
+
+
+def main (argv=None):
+    args = parse_args(argv)
+    prof = Profiler(enabled=args.profile is not None)
+    if args.metrics:
+        metrics.enable()
+    if args.progress:
+        metrics.start_progress(sys.stderr, args.progress)
+    try:
+        with prof.stage(args.command):
+            args.func(args, prof)
+    finally:
+        metrics.stop_progress()
+    if args.profile:
+        prof.write(args.profile)
+    if args.metrics:
+        if args.metrics.endswith('.prom'):
+            metrics.write_prometheus(args.metrics)
+        else:
+            metrics.write_json(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
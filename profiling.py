@@ -0,0 +1,93 @@
+"""
+Per-stage profiling for pipeline runs: wall time, CPU time, peak
+resident memory and throughput, written as a JSON report.  CPU time and
+peak memory of worker processes (e.g. -p in pipeline.py) are reported
+separately as children_cpu_s and children_peak_rss_kb; they cover
+child processes that have exited and been waited for.
+"""
+import os
+import sys
+import time
+import json
+import socket
+import resource
+from contextlib import contextmanager
+
+
+def _cpu_time (who=resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss_kb (who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and bytes on Mac OS X; for
+    # RUSAGE_CHILDREN it is the largest of the children
+    peak = resource.getrusage(who).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+class Profiler:
+    """
+    Usage:
+    prof = Profiler()
+    with prof.stage('load_tree') as stage:
+        tree = load_tree(treefile)
+        stage['items'] = tree.ntips
+    prof.write('profile.json')
+
+    A disabled profiler still runs the stages but records nothing.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+        self.started = time.time()
+    
+    
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block.  Set record['items'] to the number of
+        items processed to get a rate.
+        """
+        record = {'name': name, 'items': 0}
+        if not self.enabled:
+            yield record
+            return
+        
+        wall = time.time()
+        cpu = _cpu_time()
+        children_cpu = _cpu_time(resource.RUSAGE_CHILDREN)
+        rss = _peak_rss_kb()
+        try:
+            yield record
+        finally:
+            record['wall_s'] = time.time() - wall
+            record['cpu_s'] = _cpu_time() - cpu
+            record['children_cpu_s'] = _cpu_time(resource.RUSAGE_CHILDREN) - children_cpu
+            record['peak_rss_kb'] = _peak_rss_kb()
+            record['peak_rss_growth_kb'] = record['peak_rss_kb'] - rss
+            record['children_peak_rss_kb'] = _peak_rss_kb(resource.RUSAGE_CHILDREN)
+            record['items_per_s'] = record['items'] / record['wall_s'] if record['wall_s'] > 0 else None
+            self.stages.append(record)
+    
+    
+    def report(self):
+        return {'command': sys.argv,
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'wall_s': time.time() - self.started,
+                'cpu_s': _cpu_time(),
+                'children_cpu_s': _cpu_time(resource.RUSAGE_CHILDREN),
+                'peak_rss_kb': _peak_rss_kb(),
+                'children_peak_rss_kb': _peak_rss_kb(resource.RUSAGE_CHILDREN),
+                'stages': self.stages}
+    
+    
+    def write(self, path):
+        handle = open(path, 'w')
+        try:
+            json.dump(self.report(), handle, indent=2, sort_keys=True)
+            handle.write('\n')
+        finally:
+            handle.close()
@@ -0,0 +1,169 @@
+"""
+Quality screening of raw sequences before alignment.  All sequences are
+packed into one byte array, and per-sequence counts (length, mixtures,
+gaps and Ns, longest N run, stop codons) are taken with vectorized
+table lookups and reductions over that array, so no Python code runs
+per base.
+
+Usage:
+from qc import screen, write_report
+passed, stats, reasons = screen(fasta, min_length=1000)
+write_report(open('qc.csv', 'w'), [h for h, s in fasta], stats, reasons)
+"""
+import numpy as np
+
+
+def _char_table (chars):
+    table = np.zeros(256, dtype=bool)
+    table[[ord(c) for c in chars]] = True
+    return table
+
+
+def _mixture_chars ():
+    # the ambiguity codes matched by seqUtils.mixture_regex, less N and
+    # gaps which are counted on their own
+    from seqUtils import mixture_regex
+    return ''.join(chr(c) for c in range(256)
+                   if mixture_regex.match(chr(c)) and chr(c) not in 'N-')
+
+
+# base -> 0..3 for codon numbering, 4 for anything else
+BASE_CODE = np.full(256, 4, dtype=np.int64)
+for i, c in enumerate('TCAG'):
+    BASE_CODE[ord(c)] = i
+
+
+def _stop_table ():
+    # stop codons by index 16*first + 4*second + third, from codon_dict
+    from seqUtils import codon_dict
+    table = np.zeros(64, dtype=bool)
+    for codon, aa in codon_dict.iteritems():
+        if aa == '*':
+            table[16*BASE_CODE[ord(codon[0])] + 4*BASE_CODE[ord(codon[1])] + BASE_CODE[ord(codon[2])]] = True
+    return table
+
+
+def pack (seqs):
+    """
+    Concatenate sequences into a uint8 array; sequence i is
+    buf[offsets[i]:offsets[i+1]].
+    """
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    buf = np.frombuffer(''.join(seqs).upper(), dtype=np.uint8)
+    return buf, offsets
+
+
+def _per_seq (flags, offsets):
+    # number of True values in each sequence's slice of [flags]
+    counts = np.concatenate(([0], np.cumsum(flags, dtype=np.int64)))
+    return counts[offsets[1:]] - counts[offsets[:-1]]
+
+
+def _longest_run (flags, offsets):
+    # longest run of True values within each sequence
+    nseq = len(offsets) - 1
+    res = np.zeros(nseq, dtype=np.int64)
+    if not flags.any():
+        return res
+    # runs start where a flag follows a non-flag or a sequence boundary
+    edge = np.diff(np.concatenate(([0], flags.view(np.int8), [0])))
+    starts = np.flatnonzero(edge == 1)
+    ends = np.flatnonzero(edge == -1)
+    # split runs that cross from one sequence into the next
+    bounds = np.unique(offsets[1:-1])
+    bounds = bounds[(bounds > 0) & (bounds < len(flags))]
+    inner = bounds[flags[bounds] & flags[bounds-1]]
+    starts = np.sort(np.concatenate((starts, inner)))
+    ends = np.sort(np.concatenate((ends, inner)))
+    seq = np.searchsorted(offsets, starts, side='right') - 1
+    np.maximum.at(res, seq, ends - starts)
+    return res
+
+
+def qc_stats (seqs, frame=0):
+    """
+    Per-sequence QC measures as a dictionary of arrays:
+        length: number of characters
+        mixtures: ambiguous bases other than N (see seqUtils.mixture_regex)
+        gaps, ns: '-' and 'N' characters
+        gap_n_fraction: (gaps + ns) / length
+        n_run: longest run of N or '-'
+        stops: internal stop codons, reading from [frame] (a stop in the
+            last complete codon is not counted)
+    """
+    buf, offsets = pack(seqs)
+    length = np.diff(offsets)
+    stats = {'length': length}
+    stats['mixtures'] = _per_seq(_char_table(_mixture_chars())[buf], offsets)
+    gap = buf == ord('-')
+    n = buf == ord('N')
+    stats['gaps'] = _per_seq(gap, offsets)
+    stats['ns'] = _per_seq(n, offsets)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats['gap_n_fraction'] = np.where(length > 0, (stats['gaps'] + stats['ns']) / length.astype(float), 0.)
+    stats['n_run'] = _longest_run(gap | n, offsets)
+
+    # codon starts: offsets[i] + frame + 3k, for every complete codon
+    ncodons = np.maximum((length - frame) // 3, 0)
+    first = np.repeat(offsets[:-1] + frame, ncodons)
+    within = np.arange(len(first)) - np.repeat(np.cumsum(ncodons) - ncodons, ncodons)
+    pos = first + 3*within
+    code = BASE_CODE[buf]
+    c1, c2, c3 = code[pos], code[pos+1], code[pos+2]
+    valid = (c1 < 4) & (c2 < 4) & (c3 < 4)
+    stop = np.zeros(len(pos), dtype=bool)
+    stop[valid] = _stop_table()[16*c1[valid] + 4*c2[valid] + c3[valid]]
+    stop[(within == np.repeat(ncodons, ncodons) - 1)] = False  # terminal codon
+    stats['stops'] = np.bincount(np.repeat(np.arange(len(seqs)), ncodons)[stop],
+                                 minlength=len(seqs))
+    return stats
+
+
+def screen (records, min_length=500, max_mixtures=50, max_gap_n_fraction=0.1,
+            max_n_run=100, max_stops=0, frame=0):
+    """
+    Apply QC thresholds to (header, sequence) records.  A threshold of
+    None is not applied.
+    Returns (passed records, stats from qc_stats(), reasons), where
+    reasons[i] is a ';'-separated list of failed tests ('' if passed).
+    """
+    records = list(records)
+    stats = qc_stats([s for h, s in records], frame)
+    tests = [('length', min_length, np.less),
+             ('mixtures', max_mixtures, np.greater),
+             ('gap_n_fraction', max_gap_n_fraction, np.greater),
+             ('n_run', max_n_run, np.greater),
+             ('stops', max_stops, np.greater)]
+
+    reasons = [[] for r in records]
+    for name, limit, fails in tests:
+        if limit is None:
+            continue
+        for i in np.flatnonzero(fails(stats[name], limit)).tolist():
+            reasons[i].append('%s=%s' % (name, _format(stats[name][i])))
+    reasons = [';'.join(r) for r in reasons]
+    passed = [rec for rec, r in zip(records, reasons) if not r]
+    return passed, stats, reasons
+
+
+def _format (value):
+    if isinstance(value, (float, np.floating)):
+        return '%.4g' % value
+    return str(value)
+
+
+REPORT_COLUMNS = ['length', 'mixtures', 'gaps', 'ns', 'gap_n_fraction', 'n_run', 'stops']
+
+def write_report (handle, names, stats, reasons, rejected_only=False):
+    """
+    Write the QC measures and outcome of every sequence (or only the
+    rejected ones) as CSV.
+    """
+    handle.write('name,%s,status,reasons\n' % ','.join(REPORT_COLUMNS))
+    columns = [stats[c].tolist() for c in REPORT_COLUMNS]
+    for i, name in enumerate(names):
+        if rejected_only and not reasons[i]:
+            continue
+        handle.write('%s,%s,%s,%s\n' % (name, ','.join(_format(col[i]) for col in columns),
+                                        'fail' if reasons[i] else 'pass', reasons[i]))
@@ -1,5 +1,9 @@
-import sys, HyPhy, re, math
+import os, sys, re, math
 import random
+import tempfile
+import metrics
+
+metrics.describe('sequtils_fasta_records', 'FASTA records parsed')
 
 def convert_fasta (lines):  
     blocks = []
@@ -21,6 +25,8 @@ def convert_fasta (lines):
     except:
         print lines
         raise
+    if metrics.enabled:
+        metrics.inc('sequtils_fasta_records', len(blocks))
     return blocks
 
 
@@ -44,61 +50,265 @@ def parse_fasta (handle):
         else:
             sequence += i.strip('\n').upper()
     res.update({h: sequence})
+    if metrics.enabled:
+        metrics.inc('sequtils_fasta_records', len(res))
     return res
 
-def iter_fasta (handle):
+def iter_fasta (handle, count=True):
     """
     Parse open file as FASTA.  Returns a generator
-    of handle, sequence tuples.
+    of handle, sequence tuples.  With count=False the records are
+    not added to the sequtils_fasta_records counter, e.g. when the
+    same file is read twice.
     """
+    count = count and metrics.enabled
     sequence = ''
     for i in handle:
         if i[0] == '$': # skip h info
             continue
         elif i[0] == '>' or i[0] == '#':
             if len(sequence) > 0:
+                if count:
+                    metrics.inc('sequtils_fasta_records')
                 yield h, sequence
                 sequence = ''   # reset containers
             h = i.strip('\n')[1:]
         else:
             sequence += i.strip('\n').upper()
+    if count:
+        metrics.inc('sequtils_fasta_records')
     yield h, sequence
 
 
-def fasta2phylip (fasta, handle):
+# characters that PHYLIP and Newick readers choke on in taxon names;
+#   whitespace is converted to underscores, everything else is dropped
+phylip_regex = re.compile(r"[\s(),:;\[\]']")
+
+def _phylip_sub (match):
+    return '_' if match.group().isspace() else ''
+
+def phylip_header (h):
+    """
+    Sanitise a sequence header for PHYLIP output in a single regex pass.
+    """
+    return phylip_regex.sub(_phylip_sub, h)
+
+
+# buffer size for writing large alignments
+BUFSIZE = 1 << 20
+
+# columns of an interleaved PHYLIP alignment held in memory at once
+SPAN_BYTES = 16 << 20
+
+def open_buffered (path, mode='w'):
+    """
+    Open a file with a large output buffer for streaming writes.
+    """
+    return open(path, mode, BUFSIZE)
+
+
+def count_fasta (handle):
+    """
+    Stream through an open FASTA file to get the number of sequences
+    and the length of the first one, without keeping any sequences.
+    Needed to write a PHYLIP header before streaming the records;
+    records are not counted in sequtils_fasta_records here, only when
+    they are read for real.
+    """
+    ntaxa = 0
+    nsites = 0
+    for h, s in iter_fasta(handle, count=False):
+        if ntaxa == 0:
+            nsites = len(s)
+        ntaxa += 1
+    return ntaxa, nsites
+
+
+def write_fasta (records, handle, width=60):
+    """
+    Write (header, sequence) tuples from any iterable as FASTA with
+    sequence lines wrapped at [width] characters.  [width] of 0 or None
+    writes each sequence on a single line.
+    """
+    write = handle.write
+    for h, s in records:
+        write('>%s\n' % h)
+        if width:
+            write('\n'.join(s[i:(i+width)] for i in xrange(0, len(s), width)))
+        else:
+            write(s)
+        write('\n')
+
+
+def write_phylip (records, handle, ntaxa, nsites, interleaved=False, width=60):
+    """
+    Write (header, sequence) tuples from any iterable in PHYLIP format.
+    Headers are sanitised with phylip_header().  The number of taxa and
+    sites has to be known up front (see count_fasta()).
+
+    Sequential output writes one line per taxon as it is read.
+    Interleaved output still makes a single pass over [records]; the
+    sequences are spooled to one temporary file and read back a span
+    of columns at a time (about SPAN_BYTES for all taxa), so the
+    alignment is never held in memory.
+    """
+    write = handle.write
+    write('%d %d\n' % (ntaxa, nsites))
+
+    count = 0
+    if not interleaved:
+        for h, s in records:
+            if len(s) != nsites:
+                raise AssertionError('Sequence %s length %d does not equal header' % (h, len(s)))
+            write(phylip_header(h) + ' ' + s + '\n')
+            count += 1
+    else:
+        # taxon names only appear in the first block
+        headers = []
+        spool = tempfile.TemporaryFile('w+b', BUFSIZE)
+        try:
+            for h, s in records:
+                if len(s) != nsites:
+                    raise AssertionError('Sequence %s length %d does not equal header' % (h, len(s)))
+                headers.append(phylip_header(h))
+                spool.write(s)
+                count += 1
+            spool.flush()
+
+            # sequence i starts at i*nsites; read the same span of
+            # columns from every sequence, then write its blocks
+            fd = spool.fileno()
+            span = max(1, SPAN_BYTES // max(count, 1) // width) * width
+            for start in xrange(0, nsites, span):
+                rows = []
+                for i in xrange(count):
+                    os.lseek(fd, i*nsites + start, os.SEEK_SET)
+                    rows.append(os.read(fd, min(span, nsites-start)))
+                for offset in xrange(0, len(rows[0]) if rows else 0, width):
+                    if start + offset > 0:
+                        write('\n')
+                    for i, row in enumerate(rows):
+                        if start + offset == 0:
+                            write(headers[i] + ' ')
+                        write(row[offset:(offset+width)] + '\n')
+        finally:
+            spool.close()
+
+    if count != ntaxa:
+        raise AssertionError('Number of taxa does not equal header')
+
+
+def fasta2phylip (fasta, handle, interleaved=False):
+    """
+    Write a FASTA object (list of lists) as PHYLIP.
+    For files too large to load, use fasta2phylip_file().
+    """
     ntaxa = len(fasta)
     nsites = len(fasta[0][1])
-    handle.write(str(ntaxa)+' '+str(nsites)+'\n')
-    for row in fasta:
-        # phylip format uses space delimiters
-        header = regex.sub('',row[0]).replace(' ','_')
-        handle.write(header+' '+row[1]+'\n')
+    write_phylip(fasta, handle, ntaxa, nsites, interleaved=interleaved)
 
 
-def convert_phylip (lines):
+def fasta2phylip_file (inpath, outpath, interleaved=False):
     """
-    Convert line input from Phylip format file into
-    Python list object.
+    Convert an aligned FASTA file to PHYLIP by streaming, reading the
+    input twice (once to count taxa) and never holding the alignment.
     """
-    res = []
+    handle = open(inpath, 'rU')
+    ntaxa, nsites = count_fasta(handle)
+    handle.seek(0)
+    outfile = open_buffered(outpath)
     try:
-        ntaxa, nsites = lines[0].strip('\n').split()
+        write_phylip(iter_fasta(handle), outfile, ntaxa, nsites,
+                     interleaved=interleaved)
+    finally:
+        outfile.close()
+        handle.close()
+
+
+def iter_phylip (handle, interleaved=False):
+    """
+    Parse open file (or any iterable of lines) as PHYLIP.  Returns a
+    generator of header, sequence tuples.
+
+    Sequential files are streamed one taxon at a time; a sequence may
+    be broken over several lines.  Interleaved files have to be read
+    to the end before the first sequence is complete, so all sequences
+    are accumulated before they are yielded.
+    """
+    lines = iter(handle)
+    try:
+        first = next(lines)
+    except StopIteration:
+        return
+    try:
+        ntaxa, nsites = map(int, first.split()[:2])
     except:
-        print lines[0]
+        print first
         raise
-        
-    if len(lines) != int(ntaxa) + 1:
+
+    count = 0
+    if not interleaved:
+        h, seq, seqlen = None, [], 0
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if h is None:
+                tokens = line.split()
+                h = tokens[0]
+                seq = tokens[1:]
+                seqlen = sum(map(len, seq))
+            else:
+                chunk = line.replace(' ', '')
+                seq.append(chunk)
+                seqlen += len(chunk)
+            if seqlen >= nsites:
+                yield h, ''.join(seq).upper()
+                count += 1
+                h, seq = None, []
+        if h is not None:
+            yield h, ''.join(seq).upper()
+            count += 1
+    else:
+        headers = []
+        seqs = []
+        row = 0
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if len(headers) < ntaxa:
+                # first block carries the taxon names
+                tokens = line.split()
+                headers.append(tokens[0])
+                seqs.append(tokens[1:])
+            else:
+                seqs[row % ntaxa].append(line.replace(' ', ''))
+                row += 1
+        for h, seq in zip(headers, seqs):
+            yield h, ''.join(seq).upper()
+            count += 1
+
+    if count != ntaxa:
         raise AssertionError ('Number of taxa does not equal header')
-    
-    for line in lines[1:]:
-        header, seq = line.strip('\n').split()
-        res.append( [header, seq] )
-    
-    return res
+
+
+def convert_phylip (lines, interleaved=False):
+    """
+    Convert line input from Phylip format file into
+    Python list object.
+    """
+    return [[h, s] for h, s in iter_phylip(lines, interleaved=interleaved)]
 
 
 def import_seqs (hyphy, path_to_in):
     # use HyPhy file handler to import sequences
+    #   read_seqs() returns the same thing without going through HyPhy
+    #   HyPhy is only loaded here, when no instance is passed, so that
+    #   the rest of this module works without it
+    if hyphy is None:
+        import HyPhy
+        hyphy = HyPhy._THyPhy(os.getcwd(), 1)
     
     #dump = hyphy.ExecuteBF("DataSet ds = ReadDataFile("+os.getcwd()+'/'+path_to_in+");", False)
     dump = hyphy.ExecuteBF("DataSet ds = ReadDataFile("+path_to_in+");", False)
@@ -140,6 +350,135 @@ def import_seqs (hyphy, path_to_in):
     
     return sd
 
+nexus_comment = re.compile(r'\[[^\]]*\]')
+nexus_nchar = re.compile(r'NCHAR\s*=\s*(\d+)', re.I)
+nexus_interleave = re.compile(r'INTERLEAVE(\s*=\s*(\w+))?', re.I)
+
+def _nexus_row (line):
+    # split a MATRIX row into taxon name and sequence; names may be quoted
+    if line[0] == "'":
+        end = line.index("'", 1)
+        return line[1:end], line[(end+1):].replace(' ', '')
+    tokens = line.split()
+    return tokens[0], ''.join(tokens[1:])
+
+
+def iter_nexus (handle):
+    """
+    Parse open file as NEXUS, reading the MATRIX of the first DATA or
+    CHARACTERS block.  Returns a generator of header, sequence tuples.
+    Sequential matrices are streamed; interleaved matrices have to be
+    read through before any sequence is complete.
+    """
+    nchar = None
+    interleaved = False
+    in_matrix = False
+    h, seq = None, []
+    headers, seqs, row = [], {}, 0
+
+    for line in handle:
+        line = nexus_comment.sub('', line).strip()
+        if not line:
+            continue
+
+        if not in_matrix:
+            m = nexus_nchar.search(line)
+            if m:
+                nchar = int(m.group(1))
+            m = nexus_interleave.search(line)
+            if m and (m.group(2) is None or m.group(2).upper() in ('YES', 'TRUE')):
+                interleaved = True
+            if line.upper().startswith('MATRIX'):
+                in_matrix = True
+            continue
+
+        done = line.endswith(';')
+        line = line.rstrip(';').strip()
+
+        if line:
+            if interleaved:
+                name, chunk = _nexus_row(line)
+                if name not in seqs:
+                    headers.append(name)
+                    seqs[name] = []
+                seqs[name].append(chunk)
+            elif h is None:
+                h, chunk = _nexus_row(line)
+                seq = [chunk]
+            else:
+                seq.append(line.replace(' ', ''))
+
+            if h is not None and (nchar is None or sum(map(len, seq)) >= nchar):
+                yield h, ''.join(seq).upper()
+                h, seq = None, []
+
+        if done:
+            break
+
+    if h is not None:
+        yield h, ''.join(seq).upper()
+    for name in headers:
+        yield name, ''.join(seqs[name]).upper()
+
+
+def sniff_format (path):
+    """
+    Guess sequence file format from its first non-blank line.
+    Returns 'fasta', 'nexus' or 'phylip'.
+    """
+    handle = open(path, 'rU')
+    try:
+        for line in handle:
+            line = line.strip()
+            if not line:
+                continue
+            if line.upper().startswith('#NEXUS'):
+                return 'nexus'
+            if line[0] in '>#$':
+                return 'fasta'
+            tokens = line.split()
+            if len(tokens) >= 2 and tokens[0].isdigit() and tokens[1].isdigit():
+                return 'phylip'
+            break
+    finally:
+        handle.close()
+    raise ValueError('Unrecognized sequence file format: %s' % path)
+
+
+def iter_seqs (path, format=None, interleaved=False):
+    """
+    Native replacement for the HyPhy file reader behind import_seqs().
+    Lazily yields (header, {'rawseq': sequence}) tuples from a FASTA,
+    NEXUS or PHYLIP file, dropping the 'Standard' consensus sequence
+    from Conan's pipeline and '?' characters like HyPhy does.
+    [interleaved] only applies to PHYLIP, which does not say so itself.
+    """
+    if format is None:
+        format = sniff_format(path)
+    handle = open(path, 'rU')
+    if format == 'fasta':
+        records = iter_fasta(handle)
+    elif format == 'nexus':
+        records = iter_nexus(handle)
+    else:
+        records = iter_phylip(handle, interleaved=interleaved)
+    try:
+        for h, s in records:
+            if 'Standard' in h:
+                continue
+            yield h, {'rawseq': s.replace('?', '')}
+    finally:
+        handle.close()
+
+
+def read_seqs (path, format=None, interleaved=False):
+    """
+    Returns the same dictionary as import_seqs() without going
+    through HyPhy.
+    """
+    return dict(iter_seqs(path, format, interleaved))
+
+
 complement_dict = {'A':'T', 'C':'G', 'G':'C', 'T':'A', 
                     'W':'S', 'R':'Y', 'K':'M', 'Y':'R', 'S':'W', 'M':'K',
                     'B':'V', 'D':'H', 'H':'D', 'V':'B',
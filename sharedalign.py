@@ -0,0 +1,237 @@
+"""
+An aligned sequence matrix and its tip names in shared memory, so that
+worker processes map one copy instead of each unpickling their own.
+multiprocessing.shared_memory is not available in Python 2, so the
+segment is a file in /dev/shm (the temporary directory if there is no
+/dev/shm) mapped with mmap; workers attach to it by name and read the
+sequences with no copy.  The publishing process removes the file on
+close(), at the end of a with block, or at exit.
+
+Usage:
+from sharedalign import SharedAlignment, pair_tiles, map_tiles
+with SharedAlignment.publish(codes, names) as shared:
+    blocks = map_tiles(func, shared, pair_tiles(len(codes), 1024), processes=8)
+
+where func(alignment, tile) is a module-level function; [alignment] is
+the SharedAlignment attached in the worker.
+"""
+import os
+import mmap
+import struct
+import atexit
+import tempfile
+import binascii
+import numpy as np
+
+
+MAGIC = 'VANALIGN'
+_HEADER = struct.Struct('<8sqqq')  # magic, nseq, nsites, bytes of names
+
+# files published by this process, removed at exit
+_published = {}
+
+
+def _directory ():
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def _pad (nbytes):
+    # round up to a multiple of 8, so that the name offsets are aligned
+    return (nbytes + 7) & ~7
+
+
+class SharedAlignment:
+    """
+    Read-only view of a published alignment:
+        name: to attach to it from another process
+        codes: (nseq, nsites) uint8 array of character codes, as
+            from njtree.encode()
+        names: tip names, or None if none were published
+
+    A SharedAlignment pickles as its name, so passing one to a worker
+    attaches to the same memory there.  Arrays taken from [codes] stay
+    valid after close().
+    """
+    def __init__(self, name, directory=None, owner=False):
+        self.name = name
+        self.directory = directory or _directory()
+        self.owner = owner
+        if os.sep in name:
+            raise ValueError('Not a shared alignment name: %s' % name)
+        self.path = os.path.join(self.directory, name)
+
+        handle = open(self.path, 'rb')
+        try:
+            buf = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            handle.close()  # the mapping stays open
+        magic, nseq, nsites, nbytes = _HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError('Not a shared alignment: %s' % self.path)
+
+        offset = _HEADER.size
+        self.codes = np.frombuffer(buf, dtype=np.uint8, count=nseq*nsites,
+                                   offset=offset).reshape(nseq, nsites)
+        offset = _pad(offset + nseq*nsites)
+        self._name_offsets = None
+        self._name_bytes = None
+        if nbytes >= 0:
+            self._name_offsets = np.frombuffer(buf, dtype=np.int64, count=nseq+1, offset=offset)
+            offset += 8 * (nseq+1)
+            self._name_bytes = buf[offset:offset+nbytes]
+        self._names = None
+
+    @classmethod
+    def publish (cls, codes, names=None, directory=None):
+        """
+        Copy an (nseq, nsites) array of character codes, and optionally
+        the tip names, into a new shared segment owned by this process.
+        """
+        codes = np.ascontiguousarray(codes, dtype=np.uint8)
+        if codes.ndim != 2:
+            raise ValueError('Expecting a 2-D array of character codes')
+        nseq, nsites = codes.shape
+        if names is not None:
+            names = list(names)
+            if len(names) != nseq:
+                raise ValueError('%d names for %d sequences' % (len(names), nseq))
+            name_bytes = ''.join(names)
+            name_offsets = np.concatenate(([0], np.cumsum([len(s) for s in names]))).astype(np.int64)
+
+        directory = directory or _directory()
+        name = 'vancouver-align-%d-%s' % (os.getpid(), binascii.hexlify(os.urandom(6)))
+        path = os.path.join(directory, name)
+        _published[path] = os.getpid()
+
+        handle = open(path, 'wb')
+        try:
+            handle.write(_HEADER.pack(MAGIC, nseq, nsites, -1 if names is None else len(name_bytes)))
+            handle.write(codes.tostring())
+            if names is not None:
+                handle.write('\0' * (_pad(handle.tell()) - handle.tell()))
+                handle.write(name_offsets.tostring())
+                handle.write(name_bytes)
+        except:
+            handle.close()
+            _unlink(path)
+            raise
+        handle.close()
+        return cls(name, directory, owner=True)
+
+    @classmethod
+    def attach (cls, name, directory=None):
+        """
+        Map an alignment published by another process.
+        """
+        return cls(name, directory)
+
+    @property
+    def names (self):
+        if self._names is None and self._name_offsets is not None:
+            bounds = self._name_offsets.tolist()
+            self._names = [self._name_bytes[bounds[i]:bounds[i+1]]
+                           for i in xrange(len(bounds)-1)]
+        return self._names
+
+    def __len__ (self):
+        return len(self.codes)
+
+    # pickled as its name: unpickling attaches again
+    def __getinitargs__ (self):
+        return (self.name, self.directory)
+
+    def __getstate__ (self):
+        return {}
+
+    def close (self):
+        """
+        Drop this process's view; the publisher also removes the
+        segment.  The memory is freed once no process maps it.
+        """
+        self.codes = None
+        self._name_offsets = None
+        if self.owner:
+            _unlink(self.path)
+            self.owner = False
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        self.close()
+
+
+def _unlink (path):
+    # only the publishing process removes a segment, not forked workers
+    if _published.get(path) != os.getpid():
+        return
+    del _published[path]
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+@atexit.register
+def _cleanup ():
+    for path in _published.keys():
+        _unlink(path)
+
+
+def row_tiles (n, block):
+    """
+    (start, stop) blocks of [block] rows covering 0..n-1.
+    """
+    return [(start, min(start+block, n)) for start in xrange(0, n, block)]
+
+
+def pair_tiles (n, block):
+    """
+    (row start, row stop, column start, column stop) blocks covering
+    the upper triangle and diagonal of an n x n matrix, e.g. of
+    pairwise distances; the lower triangle is the transpose.
+    """
+    rows = row_tiles(n, block)
+    return [(r0, r1, c0, c1) for i, (r0, r1) in enumerate(rows) for c0, c1 in rows[i:]]
+
+
+# alignment attached in each worker by _init_worker()
+_worker = {}
+
+def _init_worker (name, directory):
+    _worker['alignment'] = SharedAlignment.attach(name, directory)
+
+
+def _run_tile (task):
+    func, tile = task
+    return func(_worker['alignment'], tile)
+
+
+def imap_tiles (func, alignment, tiles, processes=None):
+    """
+    Yield func(alignment, tile) for every tile, in order, computed by a
+    pool of [processes] workers (default one per CPU) that each attach
+    to the shared alignment once.  Only the tile bounds and results
+    are pickled.  [func] must be a module-level function.  With
+    processes=1 the tiles are done in this process.
+    """
+    if processes == 1:
+        for tile in tiles:
+            yield func(alignment, tile)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(processes, _init_worker, (alignment.name, alignment.directory))
+    try:
+        for result in pool.imap(_run_tile, [(func, tile) for tile in tiles]):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def map_tiles (func, alignment, tiles, processes=None):
+    """
+    List of func(alignment, tile) for every tile; see imap_tiles().
+    """
+    return list(imap_tiles(func, alignment, tiles, processes))
@@ -0,0 +1,195 @@
+"""
+Deterministic generators of synthetic HIV-like data for benchmarks:
+sequences of pol length, birth-death trees with PATID_COLDATE_VLOAD
+tip labels as GraphMaker expects, and matching epidemiological CSVs.
+The same seed always gives the same data.
+"""
+import random
+from datetime import date
+import numpy as np
+from compacttree import CompactTree
+
+
+POL_LENGTH = 3012  # HXB2 pol, nucleotides
+
+NUCS = 'ACGT'
+
+STOPS = ('TAA', 'TAG', 'TGA')
+SENSE_CODONS = [a+b+c for a in NUCS for b in NUCS for c in NUCS if a+b+c not in STOPS]
+
+
+def random_reference (length=POL_LENGTH, seed=1):
+    """
+    Random open reading frame: sense codons only, so that sequences
+    derived from it pass the stop codon check in qc.screen().
+    """
+    rng = random.Random(seed)
+    codons = [rng.choice(SENSE_CODONS) for i in xrange(length // 3)]
+    return ''.join(codons) + ''.join(rng.choice(NUCS) for i in xrange(length % 3))
+
+
+def mutate (seq, rng, subst=0.05, indel=0.002):
+    """
+    Copy of [seq] with point substitutions at rate [subst] and
+    codon insertions and deletions at rate [indel] per site.  [seq] is
+    read as codons from its start and mutations keep the frame and do
+    not make stop codons.
+    """
+    res = []
+    for i in xrange(0, len(seq), 3):
+        codon = seq[i:(i+3)]
+        r = rng.random()
+        if r < 1.5 * indel:
+            continue  # deletion
+        if r < 3 * indel:
+            res.append(rng.choice(SENSE_CODONS))  # insertion
+        mutant = ''.join(rng.choice(NUCS) if rng.random() < subst else nuc for nuc in codon)
+        res.append(codon if mutant in STOPS else mutant)
+    return ''.join(res)
+
+
+def tip_label (patid, coldate, vload):
+    return 'P%06d_%s_%d' % (patid, coldate.isoformat(), vload)
+
+
+def _labels (n, rng, repeat=0.1, first=date(2005, 1, 1), last=date(2013, 12, 31)):
+    # PATID_COLDATE_VLOAD labels; a fraction [repeat] are further samples
+    # from an earlier patient
+    span = last.toordinal() - first.toordinal()
+    labels = []
+    patid = 0
+    for i in xrange(n):
+        if i > 0 and rng.random() < repeat:
+            p = rng.randint(1, patid)
+        else:
+            patid += 1
+            p = patid
+        coldate = date.fromordinal(first.toordinal() + rng.randrange(span))
+        labels.append(tip_label(p, coldate, int(10 ** rng.uniform(1.5, 6))))
+    return labels
+
+
+def query_seqs (n, reference=None, seed=1, subst=0.05, indel=0.002):
+    """
+    [n] unaligned queries with substitutions and indels relative to
+    the reference, as a FASTA list of [header, sequence].
+    """
+    if reference is None:
+        reference = random_reference(seed=seed)
+    rng = random.Random(seed)
+    labels = _labels(n, rng)
+    return [[h, mutate(reference, rng, subst, indel)] for h in labels]
+
+
+def aligned_seqs (n, length=POL_LENGTH, seed=1, subst=0.05, gaps=0.01, mixtures=0.002):
+    """
+    [n] aligned sequences (no indels) with a few gaps and mixtures, as
+    a FASTA list of [header, sequence].  Vectorized, so that large
+    alignments are quick to make.
+    """
+    rs = np.random.RandomState(seed)
+    ref = rs.randint(0, 4, length)
+    codes = np.tile(ref, (n, 1))
+    hit = rs.random_sample((n, length)) < subst
+    codes[hit] = rs.randint(0, 4, hit.sum())
+    hit = rs.random_sample((n, length)) < gaps
+    codes[hit] = 4
+    hit = rs.random_sample((n, length)) < mixtures
+    codes[hit] = 5 + rs.randint(0, 6, hit.sum())
+    alphabet = np.array(list('ACGT-RYKMSW'), dtype='S1')
+    chars = alphabet[codes]
+    labels = _labels(n, random.Random(seed))
+    return [[h, row.tostring()] for h, row in zip(labels, chars)]
+
+
+def birth_death_tree (ntips, birth=1., death=0.3, seed=1, depth=0.1):
+    """
+    Simulate a birth-death process until [ntips] lineages are alive,
+    prune extinct lineages and return the reconstructed tree as a
+    CompactTree, with branch lengths scaled so the root-to-tip depth is
+    [depth] substitutions per site and PATID_COLDATE_VLOAD tip labels.
+    """
+    rng = random.Random(seed)
+    while True:
+        # node arrays grow as lineages split; end time of living lineages
+        # is filled in when the simulation stops
+        parent = [-1]
+        start = [0.]
+        end = [None]
+        children = [[]]
+        active = [0]
+        t = 0.
+        while active and len(active) < ntips:
+            t += rng.expovariate(len(active) * (birth + death))
+            i = rng.randrange(len(active))
+            node = active[i]
+            end[node] = t
+            if rng.random() < birth / (birth + death):
+                for k in (0, 1):
+                    children[node].append(len(parent))
+                    parent.append(node)
+                    start.append(t)
+                    end.append(None)
+                    children.append([])
+                active[i] = children[node][0]
+                active.append(children[node][1])
+            else:
+                active[i] = active[-1]
+                active.pop()
+        if active:
+            break
+        seed += 1  # extinct, try again
+        rng = random.Random(seed)
+
+    for node in active:
+        end[node] = t
+
+    # keep nodes with living descendants
+    alive = [False] * len(parent)
+    for node in active:
+        while node >= 0 and not alive[node]:
+            alive[node] = True
+            node = parent[node]
+
+    # preorder walk over living nodes, skipping nodes with one living
+    # child and adding their branch to the child's
+    labels = _labels(len(active), rng)
+    scale = depth / t
+    new_parent, lengths, names = [], [], []
+    stack = [(0, -1, 0.)]
+    ntip = 0
+    while stack:
+        node, up, extra = stack.pop()
+        bl = extra + end[node] - start[node]
+        kids = [c for c in children[node] if alive[c]]
+        if len(kids) == 1:
+            stack.append((kids[0], up, bl))
+            continue
+        new_id = len(new_parent)
+        new_parent.append(up)
+        lengths.append(bl * scale if up >= 0 else 0.)
+        if kids:
+            names.append(None)
+            for c in reversed(kids):
+                stack.append((c, new_id, 0.))
+        else:
+            names.append(labels[ntip])
+            ntip += 1
+
+    return CompactTree(new_parent, lengths, names)
+
+
+GENDERS = ('MALE', 'FEMALE', '')
+EXPOSURES = ('MSM', 'IDU', 'Hetero', 'Bi', 'MSM+IDU', 'Hetero+IDU', 'OriginHP', 'Unk/Miss')
+
+def write_epi_csv (handle, names, seed=1):
+    """
+    Write an epidemiological CSV with one row per name, with the
+    columns export.EpiNodeStyle reads (StudyID is the tip label).
+    """
+    rng = random.Random(seed)
+    handle.write('StudyID,Gender,Expose,YROnset,LATE?\n')
+    for name in names:
+        onset = str(rng.randint(1980, 2013)) if rng.random() < 0.9 else 'Y'
+        handle.write('%s,%s,%s,%s,%s\n' % (name, rng.choice(GENDERS), rng.choice(EXPOSURES),
+                                           onset, 'Y' if rng.random() < 0.2 else 'N'))
@@ -0,0 +1,116 @@
+"""
+Parse tip labels such as PATID_COLDATE_VLOAD_... once into columnar
+arrays, so that label-driven code never splits strings or parses dates
+again.
+"""
+from datetime import datetime, date
+import numpy as np
+
+
+class TipLabels:
+    """
+    Fields are taken from underscore-separated tokens, at the positions
+    given by [tip_labels] (as in GraphMaker):
+        PATID: patient ID (patid)
+        COLDATE: collection date (coldate, as a date ordinal, 0 if missing)
+        VLOAD: viral load (vload, NaN if missing)
+        RES: resistance call; may occur several times (resistant is True
+            if any of them is 'R')
+        IDU, MSM: risk factor flags, '1' for yes (risk is 'idu', 'msm',
+            'both' or None)
+    Without RES, IDU or MSM in [tip_labels], the layout of the original
+    drug resistance labels is assumed: resistance calls in tokens 5 to 25
+    and IDU/MSM flags in the sixth and fifth tokens from the end.
+
+    Labels without a COLDATE token can carry the date as a fixed-width
+    suffix, e.g. date_format='%d%m%y', date_suffix=6 for StudyIDs ending
+    in ddmmyy.  Without PATID the whole label (less any date suffix) is
+    the patient ID.
+
+    names: labels to parse; None entries (e.g. internal nodes of a
+        CompactTree) get missing values, so arrays can be indexed by
+        node id
+    """
+    def __init__(self, names, tip_labels=['PATID', 'COLDATE'], sep='_',
+                 date_format='%Y-%m-%d', date_suffix=None):
+        self.tip_labels = tip_labels
+        n = len(names)
+        pos = dict((field, i) for i, field in enumerate(tip_labels))
+        res_pos = [i for i, field in enumerate(tip_labels) if field == 'RES']
+        res_slice = None if res_pos else slice(5, 26)
+        idu_pos = pos.get('IDU', -6)
+        msm_pos = pos.get('MSM', -5)
+
+        self.patid = np.empty(n, dtype=object)
+        self.coldate = np.zeros(n, dtype=np.int64)
+        self.vload = np.full(n, np.nan, dtype=np.float64)
+        self.resistant = np.zeros(n, dtype=bool)
+        self.risk = np.empty(n, dtype=object)
+
+        dates = {}  # date string -> ordinal, most labels share dates
+        for i, name in enumerate(names):
+            if name is None:
+                continue
+            items = name.split(sep)
+
+            if 'PATID' in pos:
+                self.patid[i] = items[pos['PATID']]
+            elif date_suffix:
+                self.patid[i] = name[:-date_suffix]
+            else:
+                self.patid[i] = name
+
+            if 'COLDATE' in pos:
+                coldate = items[pos['COLDATE']] if pos['COLDATE'] < len(items) else ''
+            elif date_suffix:
+                coldate = name[-date_suffix:]
+            else:
+                coldate = ''
+            if coldate not in dates:
+                dates[coldate] = _parse_date(coldate, date_format)
+            self.coldate[i] = dates[coldate]
+
+            if 'VLOAD' in pos and pos['VLOAD'] < len(items):
+                try:
+                    self.vload[i] = float(items[pos['VLOAD']])
+                except ValueError:
+                    pass
+
+            if res_slice is not None:
+                self.resistant[i] = 'R' in items[res_slice]
+            else:
+                self.resistant[i] = any(items[p] == 'R' for p in res_pos if p < len(items))
+
+            try:
+                idu = items[idu_pos] == '1'
+                msm = items[msm_pos] == '1'
+            except IndexError:
+                idu = msm = False
+            if idu and msm:
+                self.risk[i] = 'both'
+            elif idu:
+                self.risk[i] = 'idu'
+            elif msm:
+                self.risk[i] = 'msm'
+
+
+    def __len__(self):
+        return len(self.patid)
+
+
+    def dates (self, index):
+        """
+        Collection dates of [index] as datetime.date objects, None if missing.
+        """
+        return [date.fromordinal(d) if d > 0 else None for d in self.coldate[index].tolist()]
+
+
+def _parse_date (s, fmt):
+    # date string to ordinal, 0 if missing or malformed
+    try:
+        if fmt == '%Y-%m-%d':
+            year, month, day = map(int, s.split('-'))
+            return date(year, month, day).toordinal()
+        return datetime.strptime(s, fmt).toordinal()
+    except ValueError:
+        return 0
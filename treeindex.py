@@ -0,0 +1,119 @@
+"""
+Lowest common ancestor (LCA) index for constant-time patristic distance
+queries between nodes of a tree with integer node ids.
+"""
+import numpy as np
+
+
+class LCAIndex:
+    """
+    Euler tour of the tree plus a sparse table over the levels of the
+    tour, so that the LCA of any two nodes is the shallowest node between
+    their first appearances in the tour, found with two table lookups.
+    Patristic distance is then
+        depth[a] + depth[b] - 2*depth[lca(a, b)]
+    where depth is the root-to-node path length.
+
+    Usage:
+    idx = LCAIndex(parent, branch_length)
+    idx.distance(3, 17)
+    idx.distances(np.array([[3, 17], [4, 9]]))
+
+    parent: array of parent node ids, -1 for the root
+    branch_length: array of lengths of the branch above each node
+    """
+    def __init__(self, parent, branch_length):
+        parent = np.asarray(parent, dtype=np.int64)
+        n = len(parent)
+        
+        # children in id order, via a stable sort on parent id
+        order = np.argsort(parent, kind='mergesort')
+        counts = np.bincount(parent[parent >= 0], minlength=n)
+        offsets = np.zeros(n+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        children = order[len(order)-offsets[-1]:]  # drop the root (parent -1)
+        
+        root = int(np.where(parent < 0)[0][0])
+        
+        self.depth = np.zeros(n, dtype=np.float64)  # root-to-node path length
+        self.level = np.zeros(n, dtype=np.int32)  # number of edges from root
+        self.first = np.zeros(n, dtype=np.int64)  # first position in tour
+        # last position in tour: descendants of v are the nodes whose
+        #   first position lies in first[v]..last[v]
+        self.last = np.zeros(n, dtype=np.int64)
+        tour = np.empty(2*n-1, dtype=np.int32)
+        
+        # iterative Euler tour; each stack entry is (node, next child slot)
+        pos = 0
+        stack = [[root, offsets[root]]]
+        tour[pos] = root
+        self.first[root] = pos
+        pos += 1
+        while stack:
+            top = stack[-1]
+            node, slot = top
+            if slot < offsets[node+1]:
+                top[1] += 1
+                child = children[slot]
+                self.depth[child] = self.depth[node] + branch_length[child]
+                self.level[child] = self.level[node] + 1
+                self.first[child] = pos
+                tour[pos] = child
+                pos += 1
+                stack.append([child, offsets[child]])
+            else:
+                stack.pop()
+                self.last[node] = pos - 1
+                if stack:
+                    tour[pos] = stack[-1][0]
+                    pos += 1
+        
+        self.tour = tour
+        m = len(tour)
+        
+        # floor(log2(x)) for every possible range length
+        self.log2 = np.zeros(m+1, dtype=np.int64)
+        self.log2[2:] = np.floor(np.log2(np.arange(2, m+1))).astype(np.int64)
+        
+        # sparse table: row k holds the shallowest node in tour[i:i+2**k]
+        nrows = int(self.log2[m]) + 1
+        self.table = np.empty((nrows, m), dtype=np.int32)
+        self.table[0] = tour
+        for k in range(1, nrows):
+            half = 1 << (k-1)
+            left = self.table[k-1, :m-half]
+            right = self.table[k-1, half:]
+            row = self.table[k]
+            row[:m-half] = np.where(self.level[left] <= self.level[right], left, right)
+            row[m-half:] = self.table[k-1, m-half:]
+    
+    
+    def lca (self, a, b):
+        """
+        Vectorized lowest common ancestor of node id arrays [a] and [b].
+        """
+        fa = self.first[a]
+        fb = self.first[b]
+        lo = np.minimum(fa, fb)
+        hi = np.maximum(fa, fb)
+        k = self.log2[hi-lo+1]
+        x = self.table[k, lo]
+        y = self.table[k, hi-(1 << k)+1]
+        return np.where(self.level[x] <= self.level[y], x, y)
+    
+    
+    def distance (self, a, b):
+        """
+        Patristic distance between two node ids in O(1).
+        """
+        return float(self.distances(np.array([[a, b]]))[0])
+    
+    
+    def distances (self, pairs):
+        """
+        Patristic distances for an (m, 2) array of node id pairs.
+        """
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        a = pairs[:, 0]
+        b = pairs[:, 1]
+        return self.depth[a] + self.depth[b] - 2*self.depth[self.lca(a, b)]